@@ -1,13 +1,20 @@
 import os
 import json
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import hashlib
 import hmac
-from flask import Flask, request, jsonify
+import threading
+import time
+import unicodedata
+import zlib
+from collections import OrderedDict
+from flask import Flask, request, jsonify, g
 from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 import pytz
-from redis import Redis
-from openai import OpenAI  # <--- THAY ĐỔI: Import OpenAI
+# `redis` và `openai` được import khi dùng lần đầu (xem `_LazyRedis`, `get_openai_client`) để giảm thời gian cold start
 
 # --- CẤU HÌNH ---
 AUTO_SEARCH_NETWORKS = ['bsc', 'eth', 'tron', 'polygon', 'arbitrum', 'base']
@@ -16,6 +23,52 @@ CHINA_TIMEZONE = pytz.timezone('Asia/Shanghai')
 BOT_TOKEN = os.getenv("TELEGRAM_TOKEN")
 CRON_SECRET = os.getenv("CRON_SECRET")
 REMINDER_THRESHOLD_MINUTES = 5
+TELEGRAM_API_BASE = os.getenv("TELEGRAM_API_BASE", "https://api.telegram.org")
+COINGECKO_API_BASE = os.getenv("COINGECKO_API_BASE", "https://api.coingecko.com/api/v3")
+GECKOTERMINAL_API_BASE = os.getenv("GECKOTERMINAL_API_BASE", "https://api.geckoterminal.com/api/v2")
+ALPHA123_API_BASE = os.getenv("ALPHA123_API_BASE", "https://alpha123.uk")
+TASK_DUE_INDEX_KEY = "task_due"  # ZSET "chat_id|task_id" -> epoch đến hạn, dùng cho cron nhắc việc
+TASK_STORE_MIGRATED_KEY = "task_store:migrated"
+PRICE_ALERTS_KEY = "price_alerts"
+PRICE_ALERTS_CHAT_INDEX_READY_KEY = "price_alerts:chat_index_ready"
+PRICE_ALERTS_TOKENS_KEY = "price_alerts:tokens"  # SET "network|address" của các token có cảnh báo đang theo dõi
+PRICE_ALERTS_BAND_INDEX_READY_KEY = "price_alerts:band_index_ready"
+GECKOTERMINAL_MULTI_LIMIT = 30  # Số địa chỉ tối đa cho mỗi lần gọi `tokens/multi`
+TOKEN_NETWORK_CACHE_TTL = 30 * 24 * 3600  # Contract -> network hầu như không đổi
+TOKEN_NETWORK_NEGATIVE_TTL = 600  # Địa chỉ không tìm thấy: chỉ nhớ trong thời gian ngắn
+TOKEN_NETWORK_CACHE_MAX_ENTRIES = int(os.getenv("TOKEN_NETWORK_CACHE_MAX_ENTRIES", "4096"))  # Giới hạn LRU trong tiến trình
+NETWORK_PROBE_CONCURRENCY = 6  # Số request dò mạng chạy song song tối đa
+GECKOTERMINAL_MULTI_CONCURRENCY = int(os.getenv("GECKOTERMINAL_MULTI_CONCURRENCY", "6"))  # Số nhóm `tokens/multi` gọi song song
+PRICE_CACHE_TTL = int(os.getenv("PRICE_CACHE_TTL", "30"))  # Giây giá CoinGecko được coi là mới
+PRICE_CACHE_STALE_TTL = int(os.getenv("PRICE_CACHE_STALE_TTL", "120"))  # Giây được dùng giá cũ trong lúc một lần gọi khác làm mới
+PRICE_CACHE_NEGATIVE_TTL = int(os.getenv("PRICE_CACHE_NEGATIVE_TTL", "300"))  # Giây nhớ id mà CoinGecko không trả giá
+PRICE_CACHE_MAX_ENTRIES = int(os.getenv("PRICE_CACHE_MAX_ENTRIES", "512"))  # Giới hạn LRU trong tiến trình
+PRICE_CACHE_STATS_KEY = "price_cache:stats"
+TELEGRAM_GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", "25"))  # tin/giây cho toàn bot (giới hạn Telegram ~30)
+TELEGRAM_PER_CHAT_RATE = float(os.getenv("TELEGRAM_PER_CHAT_RATE", "20")) / 60  # tin/giây cho mỗi nhóm (20/phút)
+TELEGRAM_SEND_CONCURRENCY = int(os.getenv("TELEGRAM_SEND_CONCURRENCY", "8"))
+TELEGRAM_SEND_TIME_BUDGET = float(os.getenv("TELEGRAM_SEND_TIME_BUDGET", "20"))
+OUTBOX_RETRY_KEY = "outbox:retry"  # ZSET tin chờ gửi lại, score = thời điểm được thử lại
+OUTBOX_MAX_ATTEMPTS = 5
+CRON_TIME_BUDGET = float(os.getenv("CRON_TIME_BUDGET", "45"))  # Giây cho mỗi lần chạy cron (dưới giới hạn của function)
+CRON_BATCH_SIZE = int(os.getenv("CRON_BATCH_SIZE", "200"))  # Số mục (cảnh báo, nhóm, công việc) xử lý mỗi lượt
+CRON_CURSOR_TTL = 24 * 3600
+CRON_SHARDS = max(1, int(os.getenv("CRON_SHARDS", "1")))  # Số shard mỗi cron; tăng lên khi gọi nhiều request cron song song
+CRON_LEASE_TTL = CRON_TIME_BUDGET + 15  # Lease tự hết hạn nếu instance giữ nó bị dừng giữa chừng
+CRON_SHARD_REST = int(os.getenv("CRON_SHARD_REST", "20"))  # Giây shard vừa chạy hết vòng không bị nhận lại
+LLM_STREAM_EDIT_INTERVAL = float(os.getenv("LLM_STREAM_EDIT_INTERVAL", "1.0"))  # Giây tối thiểu giữa hai lần sửa bản nháp
+LLM_STREAM_PREVIEW_CHARS = 4000  # Bản nháp phải nằm trong giới hạn 4096 ký tự của Telegram
+PERP_SNAPSHOT_KEY = "perp_snapshot"  # ZSET (score 0) sắp theo thứ tự từ điển: "SYMBOL\tmarket\tfunding_rate"
+PERP_SNAPSHOT_UPDATED_KEY = "perp_snapshot:updated_at"
+AIRDROP_FEED_KEY = "airdrop_feed:events"  # Danh sách sự kiện đã chuẩn hóa (kèm effective_ts)
+AIRDROP_FEED_FRESH_KEY = "airdrop_feed:fresh"  # Cờ còn hạn = chưa cần hỏi lại upstream
+AIRDROP_FEED_META_KEY = "airdrop_feed:meta"  # ETag / Last-Modified / hash nội dung lần tải trước
+AIRDROP_PRICES_KEY = "airdrop_feed:prices"  # Bảng giá dùng chung cho mọi sự kiện
+AIRDROP_FEED_TTL = int(os.getenv("AIRDROP_FEED_TTL", "60"))
+AIRDROP_PRICES_TTL = int(os.getenv("AIRDROP_PRICES_TTL", "60"))
+AIRDROP_FEED_MAX_STALE = 6 * 3600  # Vẫn dùng bản cũ khi upstream lỗi, tối đa chừng này giây
+PERP_SNAPSHOT_MAX_AGE = int(os.getenv("PERP_SNAPSHOT_MAX_AGE", "900"))  # Giây snapshot còn dùng được; cron /refresh_derivatives làm mới trước hạn
+# Ghi đè thủ công cho chỉ mục symbol -> id (ưu tiên hơn xếp hạng theo vốn hóa)
 SYMBOL_TO_ID_MAP = {
     'btc': 'bitcoin', 'eth': 'ethereum', 'bnb': 'binancecoin', 'sol': 'solana',
     'xrp': 'ripple', 'doge': 'dogecoin', 'shib': 'shiba-inu', 'degen': 'degen-base',
@@ -23,100 +76,356 @@ SYMBOL_TO_ID_MAP = {
     'ondo':'ondo-finance', 'virtual':'virtual-protocol', 'trx':'tron', 'towns':'towns',
     'in': 'infinit', 'yala': 'yala', 'vra':'verasity', 'tipn':'tipn', 'era':'caldera',
     'talent':'talent-protocol', 'bas':'bas', 'ron':'ronin', 'dolo':'dolomite', 'wod':'world-of-dypians',
-    'zent':'zentry','wod':'world-of-dypians', 'open':'openledger-2', 'mirror':'black-mirror',
+    'zent':'zentry', 'open':'openledger-2', 'mirror':'black-mirror',
     'wct':'connect-token-wct', 'stbl':'stbl', 'synd':'syndicate-3', 'mira':'mira-3', 'ff':'falcon-finance-ff',
     'xan':'anoma', 'vang':'pax-gold', 'bless':'bless-2', 'bank':'lorenzo-protocol'
 }
+SYMBOL_INDEX_KEY = "cg_symbol_index"  # HASH symbol -> CoinGecko id tốt nhất
+SYMBOL_INDEX_UPDATED_KEY = "cg_symbol_index:updated_at"
+SYMBOL_INDEX_MARKET_PAGES = 4  # Số trang `coins/markets` (250 coin/trang) dùng để xếp hạng theo vốn hóa
 
 # --- CẤU HÌNH GROQ (Dùng thư viện OpenAI nhưng trỏ về server Groq) ---
-# Import: from openai import OpenAI (Giữ nguyên dòng này ở đầu file)
+# Client chỉ được tạo ở lần gọi LLM đầu tiên: import `openai` chiếm phần lớn thời gian khởi động,
+# trong khi đa số lệnh (/gia, /list, ...) không cần tới nó.
 
 # Đổi tên biến môi trường thành GROQ_API_KEY cho rõ ràng
 GROQ_API_KEY = os.getenv("GROQ_API_KEY")
-openai_client = None
+GROQ_API_BASE = os.getenv("GROQ_API_BASE", "https://api.groq.com/openai/v1")
+_openai_client = None
+_openai_client_lock = threading.Lock()
 
-if GROQ_API_KEY:
-    try:
-        # Cấu hình Client trỏ về Groq
-        openai_client = OpenAI(
-            base_url="https://api.groq.com/openai/v1",
-            api_key=GROQ_API_KEY
-        )
-    except Exception as e:
-        print(f"Error configuring Groq: {e}")
-else:
+if not GROQ_API_KEY:
     print("Warning: GROQ_API_KEY is not set.")
+
+def get_openai_client():
+    """Trả về client Groq dùng chung (tạo một lần cho mỗi instance), hoặc None nếu chưa cấu hình/lỗi."""
+    global _openai_client
+    if _openai_client is not None or not GROQ_API_KEY: return _openai_client
+    with _openai_client_lock:
+        if _openai_client is None:
+            try:
+                from openai import OpenAI
+                _openai_client = OpenAI(base_url=GROQ_API_BASE, api_key=GROQ_API_KEY)
+            except Exception as e:
+                print(f"Error configuring Groq: {e}")
+    return _openai_client
 # ----------------------------------->
 
 # --- KẾT NỐI CƠ SỞ DỮ LIỆU ---
+class _LazyRedis:
+    """
+    Proxy tới client Redis: chỉ import `redis` và tạo client ở lần dùng đầu tiên.
+    `bool(kv)` vẫn đúng khi đã cấu hình URL nên các kiểm tra `if not kv` giữ nguyên ý nghĩa.
+    """
+    def __init__(self, url: str):
+        self._url = url
+        self._client = None
+        self._lock = threading.Lock()
+
+    def _get_client(self):
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    from redis import Redis
+                    client = Redis.from_url(self._url, decode_responses=True)
+                    pool = client.connection_pool
+                    pool.connection_class = _with_roundtrip_counter(pool.connection_class)
+                    self._client = client
+        return self._client
+
+    def __bool__(self): return True
+
+    def __getattr__(self, name): return getattr(self._get_client(), name)
+
 try:
     kv_url = os.getenv("teeboov2_REDIS_URL")
     if not kv_url: raise ValueError("teeboov2_REDIS_URL is not set.")
-    kv = Redis.from_url(kv_url, decode_responses=True)
+    kv = _LazyRedis(kv_url)
 except Exception as e:
     print(f"FATAL: Could not connect to Redis. Error: {e}"); kv = None
 
+_lua_scripts = {}
+
+def _run_lua(name: str, source: str, keys: list, args: list):
+    """Chạy script Lua (đăng ký một lần, sau đó gọi bằng EVALSHA)."""
+    script = _lua_scripts.get(name)
+    if script is None:
+        script = _lua_scripts.setdefault(name, kv.register_script(source))
+    return script(keys=keys, args=args)
+
+# --- SỐ LIỆU (METRICS) ---
+# Số liệu được gom trong bộ nhớ rồi cộng dồn vào Redis bằng một pipeline khi mỗi request kết thúc,
+# nên mọi instance serverless cùng ghi vào một bộ đếm chung. `/metrics` xuất ra theo định dạng text của Prometheus.
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "1").lower() not in ("0", "false", "no", "off")
+METRICS_COUNTERS_KEY = "metrics:counters"  # HASH 'tên{nhãn}' -> giá trị
+METRICS_HISTOGRAMS_KEY = "metrics:histograms"  # HASH 'tên{nhãn}|le' -> số mẫu rơi vào bucket (chưa cộng dồn), kèm '|sum', '|count'
+METRICS_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+_metrics_lock = threading.Lock()
+_pending_counters = {}
+_pending_histograms = {}
+_metrics_context = threading.local()  # Đếm round trip Redis của luồng hiện tại
+
+def _with_roundtrip_counter(connection_class):
+    """Lớp kết nối Redis đếm mỗi lần gửi lệnh (một pipeline = một round trip) vào luồng hiện tại."""
+    class RoundtripCountingConnection(connection_class):
+        def send_packed_command(self, command, check_health=True):
+            _metrics_context.redis_roundtrips = getattr(_metrics_context, 'redis_roundtrips', 0) + 1
+            return super().send_packed_command(command, check_health)
+    return RoundtripCountingConnection
+
+def _redis_roundtrips() -> int:
+    return getattr(_metrics_context, 'redis_roundtrips', 0)
+
+def _metric_series(name: str, labels: dict) -> str:
+    pairs = []
+    for key, value in labels.items():
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{key}="{value}"')
+    return name + "{" + ",".join(pairs) + "}"
+
+def inc_metric(name: str, value: int = 1, **labels):
+    if not METRICS_ENABLED or not value: return
+    series = _metric_series(name, labels)
+    with _metrics_lock: _pending_counters[series] = _pending_counters.get(series, 0) + value
+
+def observe_metric(name: str, value: float, buckets: tuple = METRICS_LATENCY_BUCKETS, **labels):
+    if not METRICS_ENABLED: return
+    series = _metric_series(name, labels)
+    le = next((str(bound) for bound in buckets if value <= bound), '+Inf')
+    with _metrics_lock:
+        for field, amount in ((f"{series}|{le}", 1), (f"{series}|count", 1), (f"{series}|sum", value)):
+            _pending_histograms[field] = _pending_histograms.get(field, 0) + amount
+
+def flush_metrics():
+    """Cộng dồn số liệu đang chờ vào Redis (một pipeline). Lỗi chỉ được ghi log, không ảnh hưởng request."""
+    if not kv: return
+    with _metrics_lock:
+        counters, histograms = dict(_pending_counters), dict(_pending_histograms)
+        _pending_counters.clear(); _pending_histograms.clear()
+    if not counters and not histograms: return
+    try:
+        pipe = kv.pipeline(transaction=False)
+        for field, value in counters.items(): pipe.hincrby(METRICS_COUNTERS_KEY, field, value)
+        for field, value in histograms.items():
+            if isinstance(value, float): pipe.hincrbyfloat(METRICS_HISTOGRAMS_KEY, field, value)
+            else: pipe.hincrby(METRICS_HISTOGRAMS_KEY, field, value)
+        pipe.execute()
+    except Exception as e:
+        print(f"Metrics flush failed: {e}")
+
+def render_metrics() -> str:
+    """Xuất số liệu đã cộng dồn (kèm bộ đếm cache giá và độ dài các hàng đợi) theo định dạng Prometheus."""
+    pipe = kv.pipeline(transaction=False)
+    pipe.hgetall(METRICS_COUNTERS_KEY)
+    pipe.hgetall(METRICS_HISTOGRAMS_KEY)
+    pipe.hgetall(PRICE_CACHE_STATS_KEY)
+    pipe.zcard(OUTBOX_RETRY_KEY)
+    pipe.llen(JOB_QUEUE_KEY)
+    pipe.llen(JOB_DEAD_KEY)
+    counters, histogram_fields, price_cache, outbox_pending, jobs_pending, jobs_dead = pipe.execute()
+
+    families = {}  # tên -> (kiểu, [dòng])
+    def add(name, kind, line): families.setdefault(name, (kind, []))[1].append(line)
+
+    for series, value in sorted(counters.items()):
+        add(series.split('{', 1)[0], 'counter', f"{series} {value}")
+    for event, value in sorted(price_cache.items()):
+        add('bot_price_cache_events_total', 'counter', f'bot_price_cache_events_total{{event="{event}"}} {value}')
+
+    histograms = {}
+    for field, value in histogram_fields.items():
+        series, _, part = field.rpartition('|')
+        histograms.setdefault(series, {})[part] = float(value)
+    for series, parts in sorted(histograms.items()):
+        name, labels = series.split('{', 1)
+        labels = labels.rstrip('}')
+        prefix = f"{labels}," if labels else ""
+        observed = {le for le in parts if le not in ('sum', 'count', '+Inf')}
+        bounds = sorted({(float(le), le) for le in observed | {str(bound) for bound in METRICS_LATENCY_BUCKETS}})
+        cumulative = 0
+        for _, le in bounds:
+            cumulative += parts.get(le, 0)
+            add(name, 'histogram', f'{name}_bucket{{{prefix}le="{le}"}} {int(cumulative)}')
+        add(name, 'histogram', f'{name}_bucket{{{prefix}le="+Inf"}} {int(parts.get("count", 0))}')
+        add(name, 'histogram', f"{name}_sum{{{labels}}} {parts.get('sum', 0)}")
+        add(name, 'histogram', f"{name}_count{{{labels}}} {int(parts.get('count', 0))}")
+
+    add('bot_outbox_pending', 'gauge', f"bot_outbox_pending {outbox_pending}")
+    add('bot_jobs_pending', 'gauge', f"bot_jobs_pending {jobs_pending}")
+    add('bot_jobs_dead', 'gauge', f"bot_jobs_dead {jobs_dead}")
+
+    lines = []
+    for name, (kind, series_lines) in families.items():
+        lines.append(f"# TYPE {name} {kind}")
+        lines.extend(series_lines)
+    return "\n".join(lines) + "\n"
+
+# --- HTTP CLIENT DÙNG CHUNG ---
+# Mỗi upstream có một Session riêng (pool kết nối keep-alive, tái sử dụng giữa các lần gọi khi instance còn ấm),
+# timeout mặc định và chính sách retry riêng. Telegram chỉ retry khi bị 429 vì POST bị lỗi 5xx có thể đã được xử lý.
+HTTP_POOL_MAXSIZE = int(os.getenv("HTTP_POOL_MAXSIZE", "16"))
+HTTP_MAX_RETRY_AFTER = float(os.getenv("HTTP_MAX_RETRY_AFTER", "5"))  # Giây chờ tối đa theo Retry-After
+UPSTREAMS = {
+    'telegram':      {'timeout': 10, 'retries': 2, 'backoff': 0.5, 'statuses': (429,), 'methods': ('GET', 'POST')},
+    'coingecko':     {'timeout': 15, 'retries': 2, 'backoff': 0.5, 'statuses': (429, 500, 502, 503, 504), 'methods': ('GET',)},
+    'geckoterminal': {'timeout': 10, 'retries': 2, 'backoff': 0.5, 'statuses': (429, 500, 502, 503, 504), 'methods': ('GET',)},
+    'alpha123':      {'timeout': 20, 'retries': 1, 'backoff': 0.5, 'statuses': (429, 500, 502, 503, 504), 'methods': ('GET',)},
+    'telegram_bulk': {'timeout': 10, 'retries': 1, 'backoff': 0,   'statuses': (), 'methods': ('POST',)},  # 429 do hàng đợi gửi tự xử lý
+    'internal':      {'timeout': 5,  'retries': 0, 'backoff': 0,   'statuses': (), 'methods': ('POST',)},
+}
+
+class _CappedRetry(Retry):
+    """Retry tôn trọng Retry-After nhưng không ngủ quá HTTP_MAX_RETRY_AFTER giây (giới hạn thời gian serverless)."""
+    def get_retry_after(self, response):
+        retry_after = super().get_retry_after(response)
+        return min(retry_after, HTTP_MAX_RETRY_AFTER) if retry_after is not None else None
+
+_http_sessions = {}
+
+def _get_http_session(upstream: str) -> requests.Session:
+    session = _http_sessions.get(upstream)
+    if session is None:
+        config = UPSTREAMS[upstream]
+        retry = _CappedRetry(
+            total=config['retries'], connect=config['retries'], read=0,
+            status=config['retries'], status_forcelist=config['statuses'],
+            allowed_methods=frozenset(config['methods']), backoff_factor=config['backoff'],
+            respect_retry_after_header=True, raise_on_status=False
+        )
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=HTTP_POOL_MAXSIZE, max_retries=retry)
+        session = requests.Session()
+        session.mount("https://", adapter); session.mount("http://", adapter)
+        session = _http_sessions.setdefault(upstream, session)
+    return session
+
+def http_request(upstream: str, method: str, url: str, **kwargs) -> requests.Response:
+    """Gửi request qua Session dùng chung của upstream. Lỗi mạng vẫn ném `requests.RequestException` như trước."""
+    kwargs.setdefault('timeout', UPSTREAMS[upstream]['timeout'])
+    start = time.perf_counter()
+    try:
+        res = _get_http_session(upstream).request(method, url, **kwargs)
+    except requests.RequestException:
+        observe_metric('bot_upstream_request_duration_seconds', time.perf_counter() - start, upstream=upstream)
+        inc_metric('bot_upstream_responses_total', upstream=upstream, status='error')
+        raise
+    observe_metric('bot_upstream_request_duration_seconds', time.perf_counter() - start, upstream=upstream)
+    inc_metric('bot_upstream_responses_total', upstream=upstream, status=res.status_code)
+    # Tính cả các lần 429 đã được urllib3 retry (nằm trong lịch sử retry của response cuối).
+    retries = getattr(res.raw, 'retries', None)
+    throttled = sum(1 for attempt in (retries.history if retries else ()) if attempt.status == 429)
+    inc_metric('bot_upstream_429_total', throttled + (res.status_code == 429), upstream=upstream)
+    return res
+
 # --- LOGIC QUẢN LÝ CÔNG VIỆC ---
-def _get_processed_airdrop_events():
+AIRDROP_API_HEADERS = {
+  'referer': 'https://alpha123.uk/index.html',
+  'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
+}
+
+def _get_effective_event_ts(event) -> float | None:
     """
-    Hàm nội bộ: Lấy và xử lý dữ liệu airdrop, trả về danh sách các sự kiện
-    đã được lọc với thời gian hiệu lực đã được tính toán.
-    Đây là hàm logic cốt lõi.
+    Trả về thời gian hiệu lực của sự kiện dưới dạng epoch (giờ gốc theo múi giờ Trung Quốc).
     """
-    AIRDROP_API_URL = "https://alpha123.uk/api/data?fresh=1"
-    PRICE_API_URL = "https://alpha123.uk/api/price/?batch=today"
-    HEADERS = {
-      'referer': 'https://alpha123.uk/index.html',
-      'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
-    }
-
-    def _get_price_data():
-        try:
-            res = requests.get(PRICE_API_URL, headers=HEADERS, timeout=10)
-            if res.status_code == 200:
-                price_json = res.json()
-                if price_json.get('success') and 'prices' in price_json:
-                    return price_json['prices']
-        except Exception: pass
-        return {}
+    event_date_str = event.get('date')
+    event_time_str = event.get('time')
+    if not (event_date_str and event_time_str and ':' in event_time_str):
+        return None
+    try:
+        cleaned_time_str = event_time_str.strip().split()[0]
+        naive_dt = datetime.strptime(f"{event_date_str} {cleaned_time_str}", '%Y-%m-%d %H:%M')
+        if event.get('phase') == 2:
+            naive_dt += timedelta(hours=18)
+        return CHINA_TIMEZONE.localize(naive_dt).timestamp()
+    except Exception:
+        return None
 
-    def _get_effective_event_time(event):
-        """
-        Trả về thời gian hiệu lực của sự kiện dưới dạng datetime object (đã ở múi giờ Việt Nam).
-        """
-        event_date_str = event.get('date')
-        event_time_str = event.get('time')
-        if not (event_date_str and event_time_str and ':' in event_time_str):
-            return None
-        try:
-            cleaned_time_str = event_time_str.strip().split()[0]
-            naive_dt = datetime.strptime(f"{event_date_str} {cleaned_time_str}", '%Y-%m-%d %H:%M')
-            if event.get('phase') == 2:
-                naive_dt += timedelta(hours=18)
-            china_dt = CHINA_TIMEZONE.localize(naive_dt)
-            vietnam_dt = china_dt.astimezone(TIMEZONE)
-            return vietnam_dt
-        except Exception:
-            return None
+def _get_airdrop_prices() -> dict:
+    """Bảng giá token của alpha123, dùng chung cho mọi sự kiện và được cache ngắn hạn trong Redis."""
+    if kv:
+        cached = kv.get(AIRDROP_PRICES_KEY)
+        if cached is not None: return json.loads(cached)
+    prices = {}
+    try:
+        res = http_request('alpha123', 'GET', f"{ALPHA123_API_BASE}/api/price/?batch=today", headers=AIRDROP_API_HEADERS, timeout=10)
+        if res.status_code == 200:
+            price_json = res.json()
+            if price_json.get('success') and 'prices' in price_json:
+                prices = price_json['prices']
+    except Exception: pass
+    if kv and prices: kv.set(AIRDROP_PRICES_KEY, json.dumps(prices), ex=AIRDROP_PRICES_TTL)
+    return prices
+
+def _refresh_airdrop_feed(cached_events: list | None) -> tuple[list | None, str | None]:
+    """
+    Tải lại feed sự kiện bằng request có điều kiện (If-None-Match / If-Modified-Since) và so hash nội dung;
+    chỉ chuẩn hóa lại khi dữ liệu thực sự thay đổi.
+    Trả về: (danh sách sự kiện đã chuẩn hóa, thông báo lỗi).
+    """
+    meta = kv.hgetall(AIRDROP_FEED_META_KEY) if kv else {}
+    headers = dict(AIRDROP_API_HEADERS)
+    if cached_events is not None:
+        if meta.get('etag'): headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'): headers['If-Modified-Since'] = meta['last_modified']
 
     try:
-        airdrop_res = requests.get(AIRDROP_API_URL, headers=HEADERS, timeout=20)
+        airdrop_res = http_request('alpha123', 'GET', f"{ALPHA123_API_BASE}/api/data?fresh=1", headers=headers)
+        if airdrop_res.status_code == 304 and cached_events is not None:
+            if kv: kv.set(AIRDROP_FEED_FRESH_KEY, "1", ex=AIRDROP_FEED_TTL)
+            return cached_events, None
         if airdrop_res.status_code != 200: return None, f"❌ Lỗi khi gọi API sự kiện (Code: {airdrop_res.status_code})."
-        
-        data = airdrop_res.json()
-        airdrops = data.get('airdrops', [])
-        if not airdrops: return [], None
 
-        price_data = _get_price_data()
-        
-        for event in airdrops:
-            event['effective_dt'] = _get_effective_event_time(event)
-            event['price_data'] = price_data
-
-        return airdrops, None
+        content_hash = hashlib.sha256(airdrop_res.content).hexdigest()
+        if cached_events is not None and content_hash == meta.get('content_hash'):
+            events = cached_events
+        else:
+            events = airdrop_res.json().get('airdrops', [])
+            for event in events:
+                event['effective_ts'] = _get_effective_event_ts(event)
     except requests.RequestException: return None, "❌ Lỗi mạng khi lấy dữ liệu sự kiện."
     except json.JSONDecodeError: return None, "❌ Dữ liệu trả về từ API sự kiện không hợp lệ."
 
+    if kv:
+        pipe = kv.pipeline()
+        if events is not cached_events: pipe.set(AIRDROP_FEED_KEY, json.dumps(events), ex=AIRDROP_FEED_MAX_STALE)
+        else: pipe.expire(AIRDROP_FEED_KEY, AIRDROP_FEED_MAX_STALE)
+        pipe.delete(AIRDROP_FEED_META_KEY)
+        pipe.hset(AIRDROP_FEED_META_KEY, mapping={
+            'etag': airdrop_res.headers.get('ETag', ''),
+            'last_modified': airdrop_res.headers.get('Last-Modified', ''),
+            'content_hash': content_hash
+        })
+        pipe.set(AIRDROP_FEED_FRESH_KEY, "1", ex=AIRDROP_FEED_TTL)
+        pipe.execute()
+    return events, None
+
+def _get_processed_airdrop_events():
+    """
+    Hàm nội bộ: Lấy danh sách sự kiện airdrop từ cache feed (làm mới khi hết hạn),
+    mỗi sự kiện có `effective_dt` đã được tính sẵn (múi giờ Việt Nam).
+    Giá token không gắn vào từng sự kiện; dùng `_get_airdrop_prices()`.
+    """
+    cached_events, is_fresh = None, False
+    if kv:
+        pipe = kv.pipeline(transaction=False)
+        pipe.exists(AIRDROP_FEED_FRESH_KEY)
+        pipe.get(AIRDROP_FEED_KEY)
+        is_fresh, cached_raw = pipe.execute()
+        cached_events = json.loads(cached_raw) if cached_raw else None
+
+    events = cached_events
+    if not (is_fresh and cached_events is not None):
+        events, error_message = _refresh_airdrop_feed(cached_events)
+        if error_message:
+            if cached_events is None: return None, error_message
+            print(f"Airdrop feed refresh failed, serving cached events: {error_message}")
+            events = cached_events
+
+    if not events: return [], None
+    for event in events:
+        effective_ts = event.get('effective_ts')
+        event['effective_dt'] = datetime.fromtimestamp(effective_ts, TIMEZONE) if effective_ts else None
+    return events, None
+
 def get_airdrop_events() -> tuple[str, str | None]:
     """
     Hàm giao diện: Gọi hàm logic cốt lõi và định dạng kết quả.
@@ -188,7 +497,7 @@ def get_airdrop_events() -> tuple[str, str | None]:
         next_event_token = all_future_events[0].get('token')
 
     message_parts = []
-    price_data = processed_events[0]['price_data'] if processed_events else {}
+    price_data = _get_airdrop_prices() if all_future_events else {}
     
     if todays_events:
         today_messages = [_format_event_message(e, price_data, e['effective_dt']) for e in todays_events]
@@ -220,15 +529,156 @@ def parse_task_from_string(task_string: str) -> tuple[datetime | None, str | Non
         return now.replace(month=dt_naive.month, day=dt_naive.day, hour=dt_naive.hour, minute=dt_naive.minute, second=0, microsecond=0), name_part
     except ValueError: return None, None
 
+# Mỗi nhóm có: `task_idx:{chat_id}` (ZSET task_id -> epoch), `task_data:{chat_id}` (HASH task_id -> JSON)
+# và `task_seq:{chat_id}` (bộ đếm sinh id ổn định). Mọi thao tác ghi chạy bằng Lua nên nguyên tử phía server,
+# đồng thời giữ chỉ mục đến hạn toàn cục TASK_DUE_INDEX_KEY (member "chat_id|task_id") luôn khớp.
+_ADD_TASK_LUA = """
+local task_id = redis.call('INCR', KEYS[3])
+redis.call('HSET', KEYS[2], task_id, ARGV[2])
+redis.call('ZADD', KEYS[1], ARGV[1], task_id)
+redis.call('ZADD', KEYS[4], ARGV[1], ARGV[3] .. '|' .. task_id)
+return task_id
+"""
+_TASK_AT_LUA = """
+local ids = redis.call('ZRANGEBYSCORE', KEYS[1], '(' .. ARGV[1], '+inf', 'LIMIT', ARGV[2], 1)
+if #ids == 0 then return false end
+return {ids[1], redis.call('HGET', KEYS[2], ids[1])}
+"""
+_EDIT_TASK_LUA = """
+if redis.call('HEXISTS', KEYS[2], ARGV[1]) == 0 then return 0 end
+redis.call('HSET', KEYS[2], ARGV[1], ARGV[3])
+redis.call('ZADD', KEYS[1], ARGV[2], ARGV[1])
+redis.call('ZADD', KEYS[3], ARGV[2], ARGV[4] .. '|' .. ARGV[1])
+return 1
+"""
+_DELETE_TASK_AT_LUA = """
+local ids = redis.call('ZRANGEBYSCORE', KEYS[1], '(' .. ARGV[1], '+inf', 'LIMIT', ARGV[2], 1)
+if #ids == 0 then return false end
+local body = redis.call('HGET', KEYS[2], ids[1])
+redis.call('ZREM', KEYS[1], ids[1])
+redis.call('HDEL', KEYS[2], ids[1])
+redis.call('ZREM', KEYS[3], ARGV[3] .. '|' .. ids[1])
+return body
+"""
+_LIST_ACTIVE_TASKS_LUA = """
+local expired = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1])
+if #expired > 0 then
+    redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', ARGV[1])
+    for i = 1, #expired, 500 do
+        redis.call('HDEL', KEYS[2], unpack(expired, i, math.min(i + 499, #expired)))
+    end
+end
+local ids = redis.call('ZRANGEBYSCORE', KEYS[1], '(' .. ARGV[1], '+inf')
+local bodies = {}
+for i = 1, #ids, 500 do
+    for _, body in ipairs(redis.call('HMGET', KEYS[2], unpack(ids, i, math.min(i + 499, #ids)))) do
+        bodies[#bodies + 1] = body
+    end
+end
+return bodies
+"""
+_MIGRATE_TASK_BLOB_LUA = """
+if redis.call('GET', KEYS[5]) ~= ARGV[1] then return 0 end
+for i = 3, #ARGV, 2 do
+    local task_id = redis.call('INCR', KEYS[3])
+    redis.call('HSET', KEYS[2], task_id, ARGV[i + 1])
+    redis.call('ZADD', KEYS[1], ARGV[i], task_id)
+    redis.call('ZADD', KEYS[4], ARGV[i], ARGV[2] .. '|' .. task_id)
+end
+redis.call('DEL', KEYS[5])
+return 1
+"""
+_PRUNE_EXPIRED_TASKS_LUA = """
+local removed = 0
+for i = 1, #ARGV - 1 do
+    local score = redis.call('ZSCORE', KEYS[1], ARGV[i + 1])
+    if score and tonumber(score) <= tonumber(ARGV[1]) then
+        local task_id = string.sub(ARGV[i + 1], string.find(ARGV[i + 1], '|', 1, true) + 1)
+        redis.call('ZREM', KEYS[2 * i], task_id)
+        redis.call('HDEL', KEYS[2 * i + 1], task_id)
+        redis.call('ZREM', KEYS[1], ARGV[i + 1])
+        removed = removed + 1
+    end
+end
+return removed
+"""
+TASK_PRUNE_BATCH = 500
+_task_store_migrated = False
+
+def _task_keys(chat_id) -> list[str]:
+    return [f"task_idx:{chat_id}", f"task_data:{chat_id}"]
+
+def _migrate_chat_tasks(chat_id):
+    """
+    Chuyển blob cũ `tasks:{chat_id}` của một nhóm sang cấu trúc mới. Ghi công việc mới và xoá blob chạy trong cùng
+    một script (chỉ khi blob chưa đổi), nên lỗi giữa chừng không làm mất công việc và không nhóm nào bị chuyển hai lần.
+    """
+    key = f"tasks:{chat_id}"
+    raw = kv.get(key)
+    if raw is None: return
+    now_ts, args = datetime.now(TIMEZONE).timestamp(), [raw, chat_id]
+    for task in json.loads(raw or '[]'):
+        task_ts = datetime.fromisoformat(task['time_iso']).timestamp()
+        if task_ts > now_ts: args += [task_ts, json.dumps(task)]
+    _run_lua('migrate_tasks', _MIGRATE_TASK_BLOB_LUA, _task_keys(chat_id) + [f"task_seq:{chat_id}", TASK_DUE_INDEX_KEY, key], args)
+
+def prune_expired_tasks(now_ts: float, max_batches: int = 20) -> int:
+    """
+    Xoá công việc đã qua khỏi chỉ mục đến hạn và khỏi `task_idx`/`task_data` của từng nhóm, kể cả nhóm không còn
+    ai gọi /list. Script kiểm tra lại score nên không xoá nhầm công việc vừa được sửa sang giờ mới.
+    """
+    removed = 0
+    for _ in range(max_batches):
+        members = kv.zrangebyscore(TASK_DUE_INDEX_KEY, '-inf', now_ts, start=0, num=TASK_PRUNE_BATCH)
+        if not members: break
+        keys = [TASK_DUE_INDEX_KEY] + [key for member in members for key in _task_keys(member.split('|', 1)[0])]
+        removed += _run_lua('prune_tasks', _PRUNE_EXPIRED_TASKS_LUA, keys, [now_ts] + members)
+        if len(members) < TASK_PRUNE_BATCH: break
+    return removed
+
+def _ensure_task_store_migrated(chat_id=None) -> bool:
+    """
+    Chuyển dữ liệu cũ (một mảng JSON trong `tasks:{chat_id}`) sang cấu trúc mới.
+    Lệnh của một nhóm chỉ cần chuyển nhóm đó trước khi đọc/ghi. Cron (không có `chat_id`) chuyển toàn bộ dưới lock
+    rồi đặt cờ TASK_STORE_MIGRATED_KEY; trả về False nếu việc chuyển đang chạy ở instance khác.
+    """
+    global _task_store_migrated
+    if _task_store_migrated: return True
+    if kv.exists(TASK_STORE_MIGRATED_KEY):
+        _task_store_migrated = True; return True
+    if chat_id is not None:
+        _migrate_chat_tasks(chat_id); return True
+    if not kv.set(f"{TASK_STORE_MIGRATED_KEY}:lock", "1", nx=True, ex=120): return False
+
+    for key in list(kv.scan_iter("tasks:*")): _migrate_chat_tasks(key.split(':', 1)[1])
+    kv.delete("task_due_index", "task_due_index:ready", f"{TASK_STORE_MIGRATED_KEY}:lock")  # Chỉ mục cũ theo time_iso
+    kv.set(TASK_STORE_MIGRATED_KEY, "1")
+    _task_store_migrated = True
+    return True
+
+def _store_new_task(chat_id, task: dict, task_dt: datetime):
+    _ensure_task_store_migrated(chat_id)
+    _run_lua('add_task', _ADD_TASK_LUA, _task_keys(chat_id) + [f"task_seq:{chat_id}", TASK_DUE_INDEX_KEY], [task_dt.timestamp(), json.dumps(task), chat_id])
+
+def _get_active_tasks(chat_id) -> list[dict]:
+    """Xóa các công việc đã qua (range delete) rồi trả về công việc còn hiệu lực, đã sắp theo thời gian."""
+    _ensure_task_store_migrated(chat_id)
+    bodies = _run_lua('list_tasks', _LIST_ACTIVE_TASKS_LUA, _task_keys(chat_id), [datetime.now(TIMEZONE).timestamp()])
+    return [json.loads(body) for body in bodies if body]
+
+def _parse_task_index(index_str: str) -> int | None:
+    try:
+        task_index = int(index_str) - 1
+        return task_index if task_index >= 0 else None
+    except ValueError:
+        return None
+
 def add_task(chat_id, task_string: str) -> tuple[bool, str]:
     if not kv: return False, "Lỗi: Chức năng lịch hẹn không khả dụng do không kết nối được DB."
     task_dt, name_part = parse_task_from_string(task_string)
     if not task_dt or not name_part: return False, "❌ Cú pháp sai. Dùng: `DD/MM HH:mm - Tên công việc`."
     if task_dt < datetime.now(TIMEZONE): return False, "❌ Không thể đặt lịch cho quá khứ."
-    tasks = json.loads(kv.get(f"tasks:{chat_id}") or '[]')
-    tasks.append({"type": "simple", "time_iso": task_dt.isoformat(), "name": name_part})
-    tasks.sort(key=lambda x: x['time_iso'])
-    kv.set(f"tasks:{chat_id}", json.dumps(tasks))
+    _store_new_task(chat_id, {"type": "simple", "time_iso": task_dt.isoformat(), "name": name_part}, task_dt)
     return True, f"✅ Đã thêm lịch: *{name_part}*."
 
 def add_alpha_task(chat_id, task_string: str) -> tuple[bool, str]:
@@ -259,36 +709,28 @@ def add_alpha_task(chat_id, task_string: str) -> tuple[bool, str]:
 
     if task_dt < datetime.now(TIMEZONE): return False, "❌ Không thể đặt lịch cho quá khứ."
 
-    tasks = json.loads(kv.get(f"tasks:{chat_id}") or '[]')
-    tasks.append({
+    _store_new_task(chat_id, {
         "type": "alpha",
         "time_iso": task_dt.isoformat(),
         "name": event_name,
         "amount": amount,
         "contract": contract
-    })
-    tasks.sort(key=lambda x: x['time_iso'])
-    kv.set(f"tasks:{chat_id}", json.dumps(tasks))
+    }, task_dt)
     return True, f"✅ Đã thêm lịch Alpha: *{event_name}*."
 
 def edit_task(chat_id, index_str: str, new_task_string: str) -> tuple[bool, str]:
     if not kv: return False, "Lỗi: Chức năng lịch hẹn không khả dụng do không kết nối được DB."
-    try:
-        task_index = int(index_str) - 1
-        if task_index < 0: raise ValueError
-    except (ValueError, AssertionError):
+    task_index = _parse_task_index(index_str)
+    if task_index is None:
         return False, "❌ Số thứ tự không hợp lệ."
 
-    user_tasks = json.loads(kv.get(f"tasks:{chat_id}") or '[]')
-    now = datetime.now(TIMEZONE)
-    active_tasks = [t for t in user_tasks if datetime.fromisoformat(t['time_iso']) > now]
-
-    if task_index >= len(active_tasks):
+    _ensure_task_store_migrated(chat_id)
+    found = _run_lua('task_at', _TASK_AT_LUA, _task_keys(chat_id), [datetime.now(TIMEZONE).timestamp(), task_index])
+    if not found:
         return False, "❌ Số thứ tự không hợp lệ."
 
-    task_to_edit_ref = active_tasks[task_index]
+    task_id, task_to_edit_ref = found[0], json.loads(found[1])
     task_type = task_to_edit_ref.get("type", "simple")
-    user_tasks = [t for t in user_tasks if t['time_iso'] != task_to_edit_ref['time_iso']]
 
     if task_type == "alpha":
         try:
@@ -311,13 +753,13 @@ def edit_task(chat_id, index_str: str, new_task_string: str) -> tuple[bool, str]
             if initial_price is None:
                 return False, f"❌ Không tìm thấy token với contract `{contract[:10]}...` trên mạng BSC."
 
-            user_tasks.append({
+            new_task = {
                 "type": "alpha",
                 "time_iso": new_task_dt.isoformat(),
                 "name": event_name,
                 "amount": amount,
                 "contract": contract
-            })
+            }
             
         except (ValueError, IndexError):
             return False, "❌ Cú pháp sai. Dùng: `DD/MM HH:mm - Tên sự kiện - 'số lượng' 'contract'`."
@@ -327,40 +769,32 @@ def edit_task(chat_id, index_str: str, new_task_string: str) -> tuple[bool, str]
         if not new_task_dt or not new_name_part:
             return False, "❌ Cú pháp sai. Dùng: `DD/MM HH:mm - Tên công việc`."
         
-        user_tasks.append({
+        new_task = {
             "type": "simple",
             "time_iso": new_task_dt.isoformat(),
             "name": new_name_part
-        })
+        }
 
-    user_tasks.sort(key=lambda x: x['time_iso'])
-    kv.set(f"tasks:{chat_id}", json.dumps(user_tasks))
+    # Sửa theo id ổn định: nếu công việc vừa bị người khác xóa thì báo lỗi thay vì ghi đè nhầm.
+    if not _run_lua('edit_task', _EDIT_TASK_LUA, _task_keys(chat_id) + [TASK_DUE_INDEX_KEY], [task_id, new_task_dt.timestamp(), json.dumps(new_task), chat_id]):
+        return False, "❌ Công việc này vừa bị thay đổi, vui lòng xem lại `/list`."
     return True, f"✅ Đã sửa công việc số *{task_index + 1}*."
 
 def delete_task(chat_id, task_index_str: str) -> tuple[bool, str]:
     if not kv: return False, "Lỗi: Chức năng lịch hẹn không khả dụng do không kết nối được DB."
-    try:
-        task_index = int(task_index_str) - 1
-        if task_index < 0: raise ValueError
-    except (ValueError, AssertionError):
+    task_index = _parse_task_index(task_index_str)
+    if task_index is None:
         return False, "❌ Số thứ tự không hợp lệ."
 
-    user_tasks = json.loads(kv.get(f"tasks:{chat_id}") or '[]')
-    active_tasks = [t for t in user_tasks if datetime.fromisoformat(t['time_iso']) > datetime.now(TIMEZONE)]
-
-    if task_index >= len(active_tasks):
+    _ensure_task_store_migrated(chat_id)
+    deleted = _run_lua('delete_task_at', _DELETE_TASK_AT_LUA, _task_keys(chat_id) + [TASK_DUE_INDEX_KEY], [datetime.now(TIMEZONE).timestamp(), task_index, chat_id])
+    if not deleted:
         return False, "❌ Số thứ tự không hợp lệ."
-
-    task_to_delete = active_tasks[task_index]
-    updated_tasks = [t for t in user_tasks if t['time_iso'] != task_to_delete['time_iso']]
-    kv.set(f"tasks:{chat_id}", json.dumps(updated_tasks))
-    return True, f"✅ Đã xóa lịch hẹn: *{task_to_delete['name']}*"
+    return True, f"✅ Đã xóa lịch hẹn: *{json.loads(deleted)['name']}*"
 
 def list_tasks(chat_id) -> str:
     if not kv: return "Lỗi: Chức năng lịch hẹn không khả dụng do không kết nối được DB."
-    user_tasks = json.loads(kv.get(f"tasks:{chat_id}") or '[]')
-    active_tasks = [t for t in user_tasks if datetime.fromisoformat(t['time_iso']) > datetime.now(TIMEZONE)]
-    if len(active_tasks) < len(user_tasks): kv.set(f"tasks:{chat_id}", json.dumps(active_tasks))
+    active_tasks = _get_active_tasks(chat_id)
     if not active_tasks: return "Bạn không có lịch hẹn nào sắp tới.\nChuyển qua dùng /event để show toàn bộ sự kiện!"
     result_lines = ["*🗓️ Danh sách lịch hẹn của bạn:*"]
     for i, task in enumerate(active_tasks):
@@ -368,29 +802,203 @@ def list_tasks(chat_id) -> str:
     return "\n".join(result_lines)
 
 # --- LOGIC CRYPTO & TIỆN ÍCH BOT ---
-def get_coingecko_prices_by_symbols(symbols: list[str]) -> dict | None:
-    if not symbols: return {}
-    ids_to_fetch = [SYMBOL_TO_ID_MAP.get(s.lower(), s.lower()) for s in symbols]
-    ids_string = ",".join(ids_to_fetch)
-    url = f"https://api.coingecko.com/api/v3/simple/price"
-    params = {'ids': ids_string, 'vs_currencies': 'usd'}
+_price_cache = OrderedDict()  # {coin_id: (price hoặc None nếu CoinGecko không có, fetched_at)} - tầng LRU trong tiến trình
+_price_cache_lock = threading.Lock()
+def _fetch_coingecko_simple_prices(coin_ids: list[str]) -> dict | None:
+    """Gọi CoinGecko `simple/price`. Trả về {coin_id: price} hoặc None nếu lỗi."""
+    url = f"{COINGECKO_API_BASE}/simple/price"
+    params = {'ids': ",".join(coin_ids), 'vs_currencies': 'usd'}
     try:
-        res = requests.get(url, params=params, timeout=15)
+        res = http_request('coingecko', 'GET', url, params=params)
         if res.status_code == 200:
-            data = res.json()
-            price_map = {}
-            id_to_symbol_map = {v: k for k, v in SYMBOL_TO_ID_MAP.items()}
-            for coin_id, price_data in data.items():
-                symbol = id_to_symbol_map.get(coin_id, coin_id)
-                price_map[symbol.lower()] = price_data.get('usd', 0)
-            return price_map
-        else:
-            print(f"CoinGecko price API error: {res.status_code} - {res.text}")
-            return None
-    except requests.RequestException as e:
+            return {coin_id: price_data.get('usd', 0) for coin_id, price_data in res.json().items()}
+        print(f"CoinGecko price API error: {res.status_code} - {res.text}")
+        return None
+    except (requests.RequestException, ValueError) as e:
         print(f"Error fetching CoinGecko prices: {e}")
         return None
 
+def _remember_prices(prices: dict, fetched_at: float, pipe=None):
+    """Ghi giá vào LRU trong tiến trình và (nếu có pipe) vào tầng Redis dùng chung."""
+    with _price_cache_lock:
+        for coin_id, price in prices.items():
+            _price_cache[coin_id] = (price, fetched_at)
+            _price_cache.move_to_end(coin_id)
+        while len(_price_cache) > PRICE_CACHE_MAX_ENTRIES:
+            _price_cache.popitem(last=False)
+    if pipe is not None:
+        for coin_id, price in prices.items():
+            ttl = PRICE_CACHE_NEGATIVE_TTL if price is None else PRICE_CACHE_TTL + PRICE_CACHE_STALE_TTL
+            pipe.set(f"cg_price:{coin_id}", json.dumps({'p': price, 't': fetched_at}), ex=ttl)
+
+def _claim_price_refresh(coin_ids: list[str]) -> list[str]:
+    """Giành quyền làm mới giá cũ (khóa ngắn theo id) để chỉ một lần gọi trên mọi instance hỏi lại CoinGecko."""
+    if not kv: return coin_ids
+    try:
+        pipe = kv.pipeline(transaction=False)
+        for coin_id in coin_ids:
+            pipe.set(f"cg_price:{coin_id}:refreshing", "1", nx=True, ex=PRICE_CACHE_TTL)
+        return [coin_id for coin_id, won in zip(coin_ids, pipe.execute()) if won]
+    except Exception as e:
+        print(f"Error claiming price refresh: {e}")
+        return []
+
+def get_coingecko_prices_by_ids(coin_ids: list[str]) -> dict | None:
+    """
+    Lấy giá USD theo CoinGecko id qua cache 2 tầng (LRU trong tiến trình -> Redis).
+    Giá quá PRICE_CACHE_TTL nhưng còn trong cửa sổ stale vẫn dùng được; lần gọi giành được khóa thì làm mới
+    ngay trong request (serverless không giữ luồng nền sau khi trả lời), gộp chung với các id hết hạn hoàn toàn.
+    Id mà CoinGecko không trả về được nhớ PRICE_CACHE_NEGATIVE_TTL giây và không có trong kết quả.
+    Trả về: {coin_id: price} hoặc None nếu CoinGecko lỗi khi cần lấy giá mới.
+    """
+    coin_ids = list(dict.fromkeys(coin_ids))
+    if not coin_ids: return {}
+    now_ts = datetime.now().timestamp()
+    result, stale, stats = {}, [], {'hit_local': 0, 'hit_redis': 0, 'stale': 0, 'miss': 0}
+
+    def _classify(coin_id, price, fetched_at, tier):
+        age = now_ts - fetched_at
+        if price is None:
+            if age > PRICE_CACHE_NEGATIVE_TTL: return False
+            stats[tier] += 1; return True
+        if age <= PRICE_CACHE_TTL:
+            result[coin_id] = price; stats[tier] += 1; return True
+        if age <= PRICE_CACHE_TTL + PRICE_CACHE_STALE_TTL:
+            result[coin_id] = price; stale.append(coin_id); stats['stale'] += 1; return True
+        return False
+
+    to_check_redis = []
+    with _price_cache_lock:
+        for coin_id in coin_ids:
+            cached = _price_cache.get(coin_id)
+            if cached and now_ts - cached[1] <= (PRICE_CACHE_NEGATIVE_TTL if cached[0] is None else PRICE_CACHE_TTL):
+                _price_cache.move_to_end(coin_id)
+                _classify(coin_id, cached[0], cached[1], 'hit_local')
+            else:
+                to_check_redis.append(coin_id)
+
+    redis_entries = {}
+    if to_check_redis and kv:
+        try:
+            for coin_id, raw in zip(to_check_redis, kv.mget([f"cg_price:{c}" for c in to_check_redis])):
+                if raw: redis_entries[coin_id] = json.loads(raw)
+        except Exception as e:
+            print(f"Error reading price cache: {e}")
+
+    misses = []
+    for coin_id in to_check_redis:
+        cached = redis_entries.get(coin_id)
+        local = _price_cache.get(coin_id)
+        if cached and (not local or cached['t'] >= local[1]):
+            if _classify(coin_id, cached['p'], cached['t'], 'hit_redis'):
+                _remember_prices({coin_id: cached['p']}, cached['t']); continue
+        elif local and _classify(coin_id, local[0], local[1], 'hit_local'):
+            continue
+        misses.append(coin_id)
+
+    pipe = kv.pipeline(transaction=False) if kv else None
+    to_fetch = misses + (_claim_price_refresh(stale) if stale else [])
+    if to_fetch:
+        stats['miss'] += len(misses)
+        fetched = _fetch_coingecko_simple_prices(to_fetch)
+        if fetched is None:
+            if misses: return None  # Giá cũ vẫn dùng được nếu chỉ lần làm mới bị lỗi
+        else:
+            unknown = {coin_id: None for coin_id in to_fetch if coin_id not in fetched}
+            _remember_prices({**fetched, **unknown}, now_ts, pipe)
+            result.update(fetched)
+            for coin_id in unknown: result.pop(coin_id, None)
+
+    if pipe is not None:
+        for field, count in stats.items():
+            if count: pipe.hincrby(PRICE_CACHE_STATS_KEY, field, count)
+        try: pipe.execute()
+        except Exception as e: print(f"Error writing price cache: {e}")
+    return result
+
+def refresh_symbol_index() -> int | None:
+    """
+    Dựng lại chỉ mục symbol -> id từ `coins/list` của CoinGecko. Khi một symbol trùng nhiều coin,
+    chọn coin có vốn hóa cao nhất (theo `coins/markets`); coin ngoài bảng xếp hạng ưu tiên id trùng symbol.
+    Trả về: số symbol đã lưu, hoặc None nếu lỗi.
+    """
+    if not kv: return None
+    try:
+        res = http_request('coingecko', 'GET', f"{COINGECKO_API_BASE}/coins/list", timeout=30)
+        if res.status_code != 200: raise requests.RequestException(f"coins/list error (Code: {res.status_code})")
+        coins = res.json()
+        market_rank = {}
+        for page in range(1, SYMBOL_INDEX_MARKET_PAGES + 1):
+            params = {'vs_currency': 'usd', 'order': 'market_cap_desc', 'per_page': 250, 'page': page}
+            res = http_request('coingecko', 'GET', f"{COINGECKO_API_BASE}/coins/markets", params=params)
+            if res.status_code != 200: break
+            for coin in res.json():
+                market_rank.setdefault(coin['id'], len(market_rank))
+    except (requests.RequestException, ValueError) as e:
+        print(f"Error refreshing symbol index: {e}")
+        return None
+
+    best = {}
+    for coin in coins:
+        coin_id, symbol = coin.get('id'), (coin.get('symbol') or '').lower()
+        if not coin_id or not symbol: continue
+        rank_key = (market_rank.get(coin_id, len(market_rank)), coin_id != symbol, len(coin_id), coin_id)
+        if symbol not in best or rank_key < best[symbol][0]:
+            best[symbol] = (rank_key, coin_id)
+    index = {symbol: coin_id for symbol, (_, coin_id) in best.items()}
+    if not index: return 0
+
+    tmp_key = f"{SYMBOL_INDEX_KEY}:tmp"
+    items = list(index.items())
+    pipe = kv.pipeline()
+    pipe.delete(tmp_key)
+    for i in range(0, len(items), 1000):
+        pipe.hset(tmp_key, mapping=dict(items[i:i + 1000]))
+    pipe.rename(tmp_key, SYMBOL_INDEX_KEY)
+    pipe.set(SYMBOL_INDEX_UPDATED_KEY, datetime.now().timestamp())
+    pipe.execute()
+    _symbol_id_memo.clear()
+    return len(index)
+
+_symbol_id_memo = {}  # {symbol: coin_id} đã tra trong tiến trình này
+
+def resolve_coingecko_ids(symbols: list[str]) -> dict:
+    """
+    Đổi symbol sang CoinGecko id: SYMBOL_TO_ID_MAP -> bộ nhớ tiến trình -> HMGET trên chỉ mục Redis.
+    Chỉ mục chỉ do cron /refresh_symbol_index dựng (tải `coins/list` quá nặng cho request của người dùng);
+    khi chưa có chỉ mục hoặc symbol không có trong đó thì dùng chính symbol làm id.
+    Trả về: {symbol_lower: coin_id}.
+    """
+    resolved, pending = {}, []
+    for symbol in dict.fromkeys(s.lower() for s in symbols):
+        coin_id = SYMBOL_TO_ID_MAP.get(symbol) or _symbol_id_memo.get(symbol)
+        if coin_id: resolved[symbol] = coin_id
+        else: pending.append(symbol)
+    if not pending: return resolved
+
+    index_ids, updated_at = [None] * len(pending), None
+    if kv:
+        try:
+            pipe = kv.pipeline(transaction=False)
+            pipe.get(SYMBOL_INDEX_UPDATED_KEY)
+            pipe.hmget(SYMBOL_INDEX_KEY, pending)
+            updated_at, index_ids = pipe.execute()
+        except Exception as e:
+            print(f"Error reading symbol index: {e}")
+
+    if len(_symbol_id_memo) > 4096: _symbol_id_memo.clear()
+    for symbol, coin_id in zip(pending, index_ids):
+        resolved[symbol] = coin_id or symbol
+        if updated_at is not None: _symbol_id_memo[symbol] = resolved[symbol]
+    return resolved
+
+def get_coingecko_prices_by_symbols(symbols: list[str]) -> dict | None:
+    if not symbols: return {}
+    symbol_to_id = resolve_coingecko_ids(symbols)
+    prices = get_coingecko_prices_by_ids(list(symbol_to_id.values()))
+    if prices is None: return None
+    return {symbol: prices[coin_id] for symbol, coin_id in symbol_to_id.items() if coin_id in prices}
+
 def process_folio_text(message_text: str) -> str:
     lines = message_text.strip().split('\n')
     if lines and lines[0].lower().startswith('/folio'):
@@ -444,9 +1052,9 @@ def process_folio_text(message_text: str) -> str:
 
 def get_bsc_price_by_contract(address: str) -> float | None:
     network = 'bsc'
-    url = f"https://api.geckoterminal.com/api/v2/networks/{network}/tokens/{address}"
+    url = f"{GECKOTERMINAL_API_BASE}/networks/{network}/tokens/{address}"
     try:
-        res = requests.get(url, headers={"accept": "application/json"}, timeout=10)
+        res = http_request('geckoterminal', 'GET', url, headers={"accept": "application/json"})
         if res.status_code == 200:
             data = res.json().get('data', {}).get('attributes', {})
             price_str = data.get('price_usd')
@@ -457,32 +1065,9 @@ def get_bsc_price_by_contract(address: str) -> float | None:
     return None
 
 def get_price_by_symbol(symbol: str) -> float | None:
-    coin_id = SYMBOL_TO_ID_MAP.get(symbol.lower(), symbol.lower())
-    url = "https://api.coingecko.com/api/v3/simple/price"; params = {'ids': coin_id, 'vs_currencies': 'usd'}
-    try:
-        res = requests.get(url, params=params, timeout=10)
-        return res.json().get(coin_id, {}).get('usd') if res.status_code == 200 else None
-    except requests.RequestException: return None
-
-# --- SỬA LẠI HÀM /GT (Dùng Model Llama 3 trên Groq) ---
-def get_crypto_explanation(query: str) -> str:
-    if not openai_client:
-        return "❌ Lỗi cấu hình: Chưa cài đặt `GROQ_API_KEY` trong Settings của Vercel."
-    
-    try:
-        # Sử dụng model llama-3.3-70b-versatile (Mạnh nhất, hỗ trợ tiếng Việt tốt)
-        response = openai_client.chat.completions.create(
-            model="llama-3.3-70b-versatile", 
-            messages=[
-                {"role": "system", "content": "Bạn là một trợ lý chuyên gia về tiền điện tử. Hãy trả lời câu hỏi sau một cách ngắn gọn, súc tích, và dễ hiểu bằng tiếng Việt cho người mới bắt đầu. Tập trung vào các khía cạnh quan trọng nhất."},
-                {"role": "user", "content": query}
-            ],
-            max_tokens=1000
-        )
-        return response.choices[0].message.content.strip()
-    except Exception as e:
-        print(f"Groq API Error: {e}")
-        return f"❌ Lỗi Groq AI: {str(e)}"
+    coin_id = resolve_coingecko_ids([symbol])[symbol.lower()]
+    prices = get_coingecko_prices_by_ids([coin_id])
+    return prices.get(coin_id) if prices else None
 
 def calculate_value(parts: list) -> str:
     if len(parts) != 3: return "Cú pháp: `/calc <ký hiệu> <số lượng>`\nVí dụ: `/calc btc 0.5`"
@@ -494,82 +1079,299 @@ def calculate_value(parts: list) -> str:
     total_value = price * amount
     return f"*{symbol.upper()}*: `${price:,.2f}` x {amount_str} = *${total_value:,.2f}*"
 
-# --- SỬA LẠI HÀM /TR (Dùng Model Llama 3 trên Groq) ---
-def translate_crypto_text(text_to_translate: str) -> str:
-    if not openai_client:
-        return "❌ Lỗi cấu hình: Chưa cài đặt `GROQ_API_KEY` trong Settings của Vercel."
-    
+# --- LLM (/GT, /TR): Dùng Model Llama 3 trên Groq ---
+GROQ_MODEL = "llama-3.3-70b-versatile"  # Mạnh nhất, hỗ trợ tiếng Việt tốt
+GROQ_MAX_TOKENS = 1000
+EXPLAIN_SYSTEM_PROMPT = "Bạn là một trợ lý chuyên gia về tiền điện tử. Hãy trả lời câu hỏi sau một cách ngắn gọn, súc tích, và dễ hiểu bằng tiếng Việt cho người mới bắt đầu. Tập trung vào các khía cạnh quan trọng nhất."
+TRANSLATE_SYSTEM_PROMPT = "Act as an expert translator specializing in finance and cryptocurrency. Your task is to translate the following English text into Vietnamese. Use accurate and natural-sounding financial/crypto jargon appropriate for a savvy investment community. Preserve the original nuance and meaning. Only provide the final Vietnamese translation, without any additional explanation."
+GROQ_NOT_CONFIGURED_MESSAGE = "❌ Lỗi cấu hình: Chưa cài đặt `GROQ_API_KEY` trong Settings của Vercel."
+
+LLM_CACHE_TTL = int(os.getenv("LLM_CACHE_TTL", str(7 * 24 * 3600)))  # Giây kể từ lần dùng gần nhất
+LLM_CACHE_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", "5000"))
+LLM_CACHE_LRU_KEY = "llm_cache:lru"  # ZSET key câu trả lời -> thời điểm dùng gần nhất, dùng để loại bỏ theo LRU
+
+# KEYS: [key câu trả lời, LLM_CACHE_LRU_KEY]; ARGV: [câu trả lời, ttl, now, số mục tối đa]
+_LLM_CACHE_PUT_LUA = """
+redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[2])
+redis.call('ZADD', KEYS[2], ARGV[3], KEYS[1])
+redis.call('ZREMRANGEBYSCORE', KEYS[2], '-inf', tonumber(ARGV[3]) - tonumber(ARGV[2]))
+local excess = redis.call('ZCARD', KEYS[2]) - tonumber(ARGV[4])
+if excess > 0 then
+    local evicted = redis.call('ZPOPMIN', KEYS[2], excess)
+    for i = 1, #evicted, 2 do redis.call('DEL', evicted[i]) end
+end
+return excess
+"""
+
+def _normalize_llm_query(query: str) -> str:
+    """Chuẩn hóa câu hỏi để các cách viết khác nhau dùng chung cache: casefold, bỏ dấu, gộp khoảng trắng."""
+    text = unicodedata.normalize('NFKD', query.casefold().replace('đ', 'd'))
+    text = ''.join(ch for ch in text if not unicodedata.combining(ch))
+    return ' '.join(text.split()).rstrip(' ?!.')
+
+def _llm_cache_key(kind: str, system_prompt: str, content: str) -> str:
+    digest = hashlib.sha256("\0".join((GROQ_MODEL, system_prompt, content)).encode()).hexdigest()
+    return f"llm_cache:{kind}:{digest}"
+
+def _llm_cache_get(cache_key: str) -> str | None:
+    """Đọc câu trả lời đã cache; lần đọc trúng gia hạn TTL và cập nhật thứ tự LRU (một round trip)."""
+    if not kv: return None
     try:
-        prompt = "Act as an expert translator specializing in finance and cryptocurrency. Your task is to translate the following English text into Vietnamese. Use accurate and natural-sounding financial/crypto jargon appropriate for a savvy investment community. Preserve the original nuance and meaning. Only provide the final Vietnamese translation, without any additional explanation."
-        
-        response = openai_client.chat.completions.create(
-            model="llama-3.3-70b-versatile",
-            messages=[
-                {"role": "system", "content": prompt},
-                {"role": "user", "content": text_to_translate}
-            ],
-            max_tokens=1000
-        )
+        pipe = kv.pipeline(transaction=False)
+        pipe.getex(cache_key, ex=LLM_CACHE_TTL)
+        pipe.zadd(LLM_CACHE_LRU_KEY, {cache_key: time.time()}, xx=True)
+        cached, _ = pipe.execute()
+    except Exception as e:
+        print(f"LLM cache read failed: {e}"); return None
+    inc_metric('bot_llm_cache_total', kind=cache_key.split(':')[1], result='hit' if cached is not None else 'miss')
+    return cached
+
+def _llm_cache_put(cache_key: str, answer: str):
+    if not kv or not answer: return
+    try:
+        _run_lua('llm_cache_put', _LLM_CACHE_PUT_LUA, [cache_key, LLM_CACHE_LRU_KEY], [answer, LLM_CACHE_TTL, time.time(), LLM_CACHE_MAX_ENTRIES])
+    except Exception as e:
+        print(f"LLM cache write failed: {e}")
+
+def _groq_chat(system_prompt: str, user_content: str, on_progress=None) -> str:
+    """
+    Gọi Groq chat completion. Nếu có `on_progress`, dùng chế độ stream và gọi `on_progress(văn bản đã nhận)`
+    mỗi khi có thêm nội dung. Ném lỗi của thư viện OpenAI khi thất bại.
+    """
+    messages = [{"role": "system", "content": system_prompt}, {"role": "user", "content": user_content}]
+    if on_progress is None:
+        response = get_openai_client().chat.completions.create(model=GROQ_MODEL, messages=messages, max_tokens=GROQ_MAX_TOKENS)
         return response.choices[0].message.content.strip()
+
+    chunks = []
+    stream = get_openai_client().chat.completions.create(model=GROQ_MODEL, messages=messages, max_tokens=GROQ_MAX_TOKENS, stream=True)
+    for chunk in stream:
+        delta = chunk.choices[0].delta.content if chunk.choices else None
+        if delta:
+            chunks.append(delta)
+            on_progress("".join(chunks))
+    return "".join(chunks).strip()
+
+def get_crypto_explanation(query: str, on_progress=None) -> str:
+    # Câu hỏi được chuẩn hóa trước khi tra cache: "Airdrop là gì?" và "airdrop la gi" dùng chung câu trả lời.
+    cache_key = _llm_cache_key('gt', EXPLAIN_SYSTEM_PROMPT, _normalize_llm_query(query))
+    cached = _llm_cache_get(cache_key)
+    if cached is not None: return cached
+    if not get_openai_client(): return GROQ_NOT_CONFIGURED_MESSAGE
+    try:
+        answer = _groq_chat(EXPLAIN_SYSTEM_PROMPT, query, on_progress)
+    except Exception as e:
+        print(f"Groq API Error: {e}")
+        return f"❌ Lỗi Groq AI: {str(e)}"
+    _llm_cache_put(cache_key, answer)
+    return answer
+
+def translate_crypto_text(text_to_translate: str, on_progress=None) -> str:
+    # Bản dịch phụ thuộc từng ký tự của văn bản gốc nên chỉ dùng lại khi trùng khớp hoàn toàn.
+    cache_key = _llm_cache_key('tr', TRANSLATE_SYSTEM_PROMPT, text_to_translate)
+    cached = _llm_cache_get(cache_key)
+    if cached is not None: return cached
+    if not get_openai_client(): return GROQ_NOT_CONFIGURED_MESSAGE
+    try:
+        translation = _groq_chat(TRANSLATE_SYSTEM_PROMPT, text_to_translate, on_progress)
     except Exception as e:
         print(f"Groq API Error (Translation): {e}")
         return f"❌ Lỗi Groq AI: {str(e)}"
+    _llm_cache_put(cache_key, translation)
+    return translation
+
+def _fetch_derivatives_compact() -> list[tuple[str, str, float]]:
+    """
+    Tải toàn bộ hợp đồng phái sinh từ CoinGecko và chỉ giữ các trường cần dùng.
+    Trả về: [(symbol, market, funding_rate)]. Ném `requests.RequestException`/`ValueError` khi lỗi.
+    """
+    url = f"{COINGECKO_API_BASE}/derivatives"
+    params = {'include_tickers': 'unexpired'}
+    res = http_request('coingecko', 'GET', url, params=params, timeout=25)
+    if res.status_code != 200:
+        raise requests.RequestException(f"CoinGecko derivatives API error (Code: {res.status_code})")
+    compact = []
+    for contract in res.json() or []:
+        contract_symbol, market_name, funding_rate = contract.get('symbol'), contract.get('market'), contract.get('funding_rate')
+        if contract_symbol and market_name and funding_rate is not None:
+            compact.append((contract_symbol, market_name, float(funding_rate)))
+    return compact
+
+def refresh_derivatives_snapshot() -> int | None:
+    """
+    Làm mới snapshot phái sinh trong Redis (ghi vào key tạm rồi RENAME để thay thế nguyên tử).
+    Trả về: số hợp đồng đã lưu, hoặc None nếu lỗi.
+    """
+    if not kv: return None
+    try:
+        compact = _fetch_derivatives_compact()
+    except (requests.RequestException, ValueError) as e:
+        print(f"Error refreshing derivatives snapshot: {e}")
+        return None
+    return _store_derivatives_snapshot(compact)
+
+def _store_derivatives_snapshot(compact: list[tuple[str, str, float]]) -> int:
+    if not compact: return 0
+    tmp_key = f"{PERP_SNAPSHOT_KEY}:tmp"
+    pipe = kv.pipeline()
+    pipe.delete(tmp_key)
+    members = [f"{contract_symbol}\t{market_name}\t{funding_rate!r}" for contract_symbol, market_name, funding_rate in compact]
+    for i in range(0, len(members), 1000):
+        pipe.zadd(tmp_key, {member: 0 for member in members[i:i + 1000]})
+    pipe.rename(tmp_key, PERP_SNAPSHOT_KEY)
+    pipe.set(PERP_SNAPSHOT_UPDATED_KEY, datetime.now().timestamp())
+    pipe.execute()
+    return len(compact)
+
+def _lookup_perpetual_markets(search_symbol: str) -> tuple[list[tuple[str, str, float]] | None, bool]:
+    """
+    Tra snapshot theo tiền tố symbol.
+    Trả về: (các hợp đồng khớp hoặc None nếu chưa có snapshot, cần tải lại). Cần tải lại khi chưa có snapshot, hoặc
+    snapshot đã quá hạn (cron không chạy) và lần gọi này giành được khóa làm mới; các lần gọi khác dùng snapshot cũ.
+    """
+    pipe = kv.pipeline(transaction=False)
+    pipe.get(PERP_SNAPSHOT_UPDATED_KEY)
+    pipe.zrangebylex(PERP_SNAPSHOT_KEY, f"[{search_symbol}", f"[{search_symbol}\U0010ffff")
+    updated_at, members = pipe.execute()
+    if updated_at is None: return None, True
+    # Khóa ngắn để nhiều instance không cùng tải lại payload phái sinh.
+    needs_refresh = (datetime.now().timestamp() - float(updated_at) > PERP_SNAPSHOT_MAX_AGE
+                     and bool(kv.set(f"{PERP_SNAPSHOT_KEY}:refreshing", "1", nx=True, ex=120)))
+    matches = []
+    for member in members:
+        contract_symbol, market_name, funding_rate = member.split('\t')
+        matches.append((contract_symbol, market_name, float(funding_rate)))
+    return matches, needs_refresh
 
 def find_perpetual_markets(symbol: str) -> str:
     """Tìm các sàn CEX và DEX có hợp đồng perpetual và hiển thị funding rate."""
-    url = "https://api.coingecko.com/api/v3/derivatives"
-    params = {'include_tickers': 'unexpired'}
+    search_symbol = symbol.upper()
     
     try:
-        res = requests.get(url, params=params, timeout=25)
-        if res.status_code != 200:
-            return f"❌ Lỗi khi gọi API CoinGecko (Code: {res.status_code})."
-        
-        derivatives = res.json()
-        if not derivatives:
-            return "❌ Không thể lấy dữ liệu phái sinh từ CoinGecko."
-        
-        markets = []
-        found = False
-        search_symbol = symbol.upper()
-        
-        for contract in derivatives:
-            contract_symbol = contract.get('symbol', '')
-            
-            if contract_symbol.startswith(search_symbol):
-                found = True
-                market_name = contract.get('market')
-                funding_rate = contract.get('funding_rate')
-                
-                if market_name and funding_rate is not None:
-                    markets.append({
-                        'name': market_name,
-                        'funding_rate': float(funding_rate)
-                    })
+        contracts, needs_refresh = _lookup_perpetual_markets(search_symbol) if kv else (None, True)
+        if needs_refresh:
+            # Chưa có snapshot (lần chạy đầu, không có DB) hoặc snapshot quá hạn: tải trực tiếp đúng một lần.
+            try:
+                compact = _fetch_derivatives_compact()
+            except (requests.RequestException, ValueError) as e:
+                if contracts is None: raise
+                print(f"Error refreshing derivatives snapshot, serving stale data: {e}")
+            else:
+                if kv: _store_derivatives_snapshot(compact)
+                contracts = [c for c in compact if c[0].startswith(search_symbol)]
+    except (requests.RequestException, ValueError) as e:
+        print(f"Error in find_perpetual_markets: {e}")
+        return "❌ Lỗi mạng khi lấy dữ liệu thị trường phái sinh."
 
-        if not found or not markets:
-            return f"ℹ️ Không tìm thấy thị trường Perpetual nào có dữ liệu funding rate cho *{symbol.upper()}*."
+    markets = [{'name': market_name, 'funding_rate': funding_rate} for _, market_name, funding_rate in contracts]
+    if not markets:
+        return f"ℹ️ Không tìm thấy thị trường Perpetual nào có dữ liệu funding rate cho *{symbol.upper()}*."
 
-        markets.sort(key=lambda x: x['funding_rate'], reverse=True)
-        
-        message_parts = [f"📊 *Funding Rate cho {symbol.upper()} (Perpetual):*"]
+    markets.sort(key=lambda x: x['funding_rate'], reverse=True)
+    
+    message_parts = [f"📊 *Funding Rate cho {symbol.upper()} (Perpetual):*"]
+    
+    for market in markets[:15]:
+        rate = market['funding_rate']
+        emoji = "🟢" if rate > 0 else "🔴" if rate < 0 else "⚪️"
+        message_parts.append(f"{emoji} `{market['name']}`: `{rate:+.4f}%`")
         
-        for market in markets[:15]:
-            rate = market['funding_rate']
-            emoji = "🟢" if rate > 0 else "🔴" if rate < 0 else "⚪️"
-            message_parts.append(f"{emoji} `{market['name']}`: `{rate:+.4f}%`")
-            
-        return "\n".join(message_parts)
+    return "\n".join(message_parts)
 
-    except requests.RequestException as e:
-        print(f"Error in find_perpetual_markets: {e}")
-        return "❌ Lỗi mạng khi lấy dữ liệu thị trường phái sinh."
+def _chat_alerts_key(chat_id) -> str:
+    return f"price_alerts:chat:{chat_id}"
+
+def _ensure_chat_alert_index():
+    """Dựng chỉ mục cảnh báo theo từng nhóm từ hash toàn cục (cron kiểm tra cảnh báo chạy một lần)."""
+    pipe = kv.pipeline(transaction=False)
+    for key, _ in kv.hscan_iter(PRICE_ALERTS_KEY, count=1000):
+        chat_id, address = key.rsplit(':', 1)
+        pipe.sadd(_chat_alerts_key(chat_id), address)
+    pipe.set(PRICE_ALERTS_CHAT_INDEX_READY_KEY, "1")
+    pipe.execute()
+
+# Chỉ mục ngưỡng kích hoạt: mỗi cảnh báo được rút gọn thành giá trên / giá dưới (tính từ reference_price và
+# threshold_percent), lưu trong hai ZSET theo token. Khi có giá mới, một truy vấn khoảng trả về đúng các cảnh báo
+# bị vượt ngưỡng, nên cron chỉ tốn công cho cảnh báo kích hoạt chứ không cho mọi cảnh báo đang có.
+_DELETE_PRICE_ALERT_LUA = """
+local raw = redis.call('HGET', KEYS[1], ARGV[1])
+if not raw then return 0 end
+local network = cjson.decode(raw).network
+redis.call('HDEL', KEYS[1], ARGV[1])
+redis.call('SREM', KEYS[2], ARGV[2])
+for i = 3, #ARGV do
+    if ARGV[i] == network then
+        local upper, lower = KEYS[2 * i - 2], KEYS[2 * i - 1]
+        redis.call('ZREM', upper, ARGV[1])
+        redis.call('ZREM', lower, ARGV[1])
+        if redis.call('ZCARD', upper) == 0 and redis.call('ZCARD', lower) == 0 then redis.call('SREM', KEYS[3], network .. '|' .. ARGV[2]) end
+    end
+end
+return 1
+"""
+
+_DROP_STALE_ALERT_BANDS_LUA = """
+for i = 1, #ARGV, 2 do
+    local upper, lower = KEYS[i + 1], KEYS[i + 2]
+    redis.call('ZREM', upper, ARGV[i])
+    redis.call('ZREM', lower, ARGV[i])
+    if redis.call('ZCARD', upper) == 0 and redis.call('ZCARD', lower) == 0 then redis.call('SREM', KEYS[1], ARGV[i + 1]) end
+end
+return 1
+"""
+
+_CROSSED_PRICE_ALERTS_LUA = """
+local crossed = {}
+for i = 1, #ARGV do
+    for _, key in ipairs(redis.call('ZRANGEBYSCORE', KEYS[2 * i - 1], '-inf', ARGV[i])) do
+        crossed[#crossed + 1] = i; crossed[#crossed + 1] = key
+    end
+    for _, key in ipairs(redis.call('ZRANGEBYSCORE', KEYS[2 * i], ARGV[i], '+inf')) do
+        crossed[#crossed + 1] = i; crossed[#crossed + 1] = key
+    end
+end
+return crossed
+"""
+
+def _alert_band_keys(network: str, address: str) -> tuple[str, str]:
+    return f"price_alerts:band:{network}:{address}:upper", f"price_alerts:band:{network}:{address}:lower"
+
+def _alert_bands(alert: dict) -> tuple[float, float] | None:
+    """(giá trên, giá dưới) mà khi chạm tới thì cảnh báo kích hoạt; None nếu chưa có giá tham chiếu."""
+    ref_price, threshold = float(alert['reference_price']), float(alert['threshold_percent'])
+    if ref_price <= 0: return None
+    return ref_price * (1 + threshold / 100), ref_price * (1 - threshold / 100)
+
+def _index_alert_bands(pipe, alert_key: str, alert: dict):
+    network, address = alert['network'], alert['address'].lower()
+    upper_key, lower_key = _alert_band_keys(network, address)
+    bands = _alert_bands(alert)
+    if bands:
+        pipe.zadd(upper_key, {alert_key: bands[0]})
+        pipe.zadd(lower_key, {alert_key: bands[1]})
+        pipe.sadd(PRICE_ALERTS_TOKENS_KEY, f"{network}|{address}")
+    else:
+        pipe.zrem(upper_key, alert_key)
+        pipe.zrem(lower_key, alert_key)
+
+def _ensure_alert_band_index():
+    """Dựng chỉ mục ngưỡng kích hoạt từ hash cảnh báo (chỉ chạy một lần)."""
+    pipe = kv.pipeline(transaction=False)
+    for key, alert_json in kv.hscan_iter(PRICE_ALERTS_KEY, count=1000):
+        try: _index_alert_bands(pipe, key, json.loads(alert_json))
+        except (json.JSONDecodeError, KeyError, TypeError, ValueError) as e: print(f"Error indexing price alert {key}: {e}")
+    pipe.set(PRICE_ALERTS_BAND_INDEX_READY_KEY, "1")
+    pipe.execute()
 
 def unalert_price(chat_id, address: str) -> str:
     if not kv: return "Lỗi: Chức năng cảnh báo giá không khả dụng do không kết nối được DB."
-    alert_key = f"{chat_id}:{address.lower()}"
-    if kv.hexists("price_alerts", alert_key):
-        kv.hdel("price_alerts", alert_key)
+    # Đọc cảnh báo, gỡ khỏi dải giá và các chỉ mục trong cùng một script: một round-trip, không chen được.
+    # Chưa biết mạng trước khi đọc nên khai báo dải giá của mọi mạng; script chỉ đụng tới cặp khớp mạng đã lưu.
+    band_keys = [key for network in AUTO_SEARCH_NETWORKS for key in _alert_band_keys(network, address.lower())]
+    removed = _run_lua('delete_alert', _DELETE_PRICE_ALERT_LUA,
+                       [PRICE_ALERTS_KEY, _chat_alerts_key(chat_id), PRICE_ALERTS_TOKENS_KEY, *band_keys],
+                       [f"{chat_id}:{address.lower()}", address.lower(), *AUTO_SEARCH_NETWORKS])
+    if removed:
         return f"✅ Đã xóa cảnh báo giá cho token `{address[:6]}...{address[-4:]}`."
     else:
         return f"❌ Không tìm thấy cảnh báo nào cho token `{address[:6]}...{address[-4:]}`."
@@ -600,23 +1402,36 @@ def set_price_alert(chat_id, address: str, percentage_str: str) -> str:
         "reference_price": current_price
     }
     
-    kv.hset("price_alerts", f"{chat_id}:{address.lower()}", json.dumps(alert_data))
+    pipe = kv.pipeline()
+    pipe.hset(PRICE_ALERTS_KEY, f"{chat_id}:{address.lower()}", json.dumps(alert_data))
+    pipe.sadd(_chat_alerts_key(chat_id), address.lower())
+    _index_alert_bands(pipe, f"{chat_id}:{address.lower()}", alert_data)
+    pipe.execute()
     
     return (f"✅ Đã đặt cảnh báo cho *{token_info['name']} (${token_info['symbol']})*.\n"
             f"Bot sẽ thông báo mỗi khi giá thay đổi `±{percentage}%` so với giá tham chiếu hiện tại là `${current_price:,.4f}`.")
 
 def list_price_alerts(chat_id) -> str:
     if not kv: return "Lỗi: Chức năng cảnh báo giá không khả dụng do không kết nối được DB."
-    all_alerts_raw = kv.hgetall("price_alerts")
+    pipe = kv.pipeline(transaction=False)
+    pipe.exists(PRICE_ALERTS_CHAT_INDEX_READY_KEY)
+    pipe.smembers(_chat_alerts_key(chat_id))
+    index_ready, addresses = pipe.execute()
+    if not index_ready:
+        # Chỉ mục theo nhóm do cron /check_alerts dựng; trong lúc chờ chỉ đọc các field của nhóm này.
+        addresses = {key.rsplit(':', 1)[1] for key, _ in kv.hscan_iter(PRICE_ALERTS_KEY, match=f"{chat_id}:*", count=1000)}
+
+    # Chỉ đọc các cảnh báo của nhóm này từ hash toàn cục.
+    addresses = sorted(addresses)
+    alerts_raw = kv.hmget(PRICE_ALERTS_KEY, [f"{chat_id}:{address}" for address in addresses]) if addresses else []
     user_alerts = []
     
-    for key, alert_json in all_alerts_raw.items():
-        if key.startswith(f"{chat_id}:"):
-            try:
-                alert = json.loads(alert_json)
-                user_alerts.append(alert)
-            except json.JSONDecodeError:
-                continue
+    for alert_json in alerts_raw:
+        if not alert_json: continue
+        try:
+            user_alerts.append(json.loads(alert_json))
+        except json.JSONDecodeError:
+            continue
     
     if not user_alerts:
         return "Bạn chưa đặt cảnh báo giá nào."
@@ -633,232 +1448,911 @@ def list_price_alerts(chat_id) -> str:
         )
     return "\n".join(message_parts)
 
+_token_network_cache = OrderedDict()  # {address_lower: (network hoặc "" nếu không tìm thấy, expires_at)} - LRU
+_token_network_cache_lock = threading.Lock()
+
+def _remember_token_network(key: str, network: str, expires_at: float):
+    with _token_network_cache_lock:
+        _token_network_cache[key] = (network, expires_at)
+        _token_network_cache.move_to_end(key)
+        while len(_token_network_cache) > TOKEN_NETWORK_CACHE_MAX_ENTRIES:
+            _token_network_cache.popitem(last=False)
+
+def _get_cached_token_network(address: str) -> str | None:
+    """
+    Tra cache contract -> network (bộ nhớ tiến trình trước, Redis sau).
+    Trả về: tên network, "" nếu địa chỉ đã được xác định là không tồn tại, hoặc None nếu chưa biết.
+    """
+    key = address.lower()
+    with _token_network_cache_lock:
+        cached = _token_network_cache.get(key)
+        if cached and cached[1] > datetime.now().timestamp():
+            _token_network_cache.move_to_end(key)
+            return cached[0]
+    if not kv: return None
+    try:
+        pipe = kv.pipeline(transaction=False)
+        pipe.get(f"token_network:{key}")
+        pipe.ttl(f"token_network:{key}")
+        network, ttl = pipe.execute()
+    except Exception as e:
+        print(f"Error reading token network cache: {e}"); return None
+    if network is None: return None
+    _remember_token_network(key, network, datetime.now().timestamp() + max(ttl, 0))
+    return network
+
+def _set_cached_token_network(address: str, network: str | None):
+    key = address.lower()
+    ttl = TOKEN_NETWORK_CACHE_TTL if network else TOKEN_NETWORK_NEGATIVE_TTL
+    _remember_token_network(key, network or "", datetime.now().timestamp() + ttl)
+    if not kv: return
+    try: kv.set(f"token_network:{key}", network or "", ex=ttl)
+    except Exception as e: print(f"Error writing token network cache: {e}")
+
+_probe_executor = None
+
+def _get_probe_executor() -> ThreadPoolExecutor:
+    global _probe_executor
+    if _probe_executor is None:
+        _probe_executor = ThreadPoolExecutor(max_workers=NETWORK_PROBE_CONCURRENCY, thread_name_prefix="network-probe")
+    return _probe_executor
+
+def _fetch_token_attributes(network: str, address: str, include_top_pools: bool = False) -> tuple[dict | None, bool]:
+    """
+    Gọi GeckoTerminal cho một mạng cụ thể.
+    Trả về: (attributes hoặc None, True nếu kết quả là chắc chắn - tìm thấy hoặc 404).
+    """
+    url = f"{GECKOTERMINAL_API_BASE}/networks/{network}/tokens/{address}"
+    if include_top_pools: url += "?include=top_pools"
+    try:
+        res = http_request('geckoterminal', 'GET', url, headers={"accept": "application/json"})
+        if res.status_code == 200:
+            attrs = res.json().get('data', {}).get('attributes', {})
+            return (attrs, True) if attrs and attrs.get('name') else (None, True)
+        return None, res.status_code == 404
+    except (requests.RequestException, ValueError):
+        return None, False
+
+def find_token_network(address: str, include_top_pools: bool = False) -> tuple[str | None, dict | None]:
+    """
+    Xác định token nằm trên mạng nào, dùng cache contract -> network để tránh dò lại
+    toàn bộ AUTO_SEARCH_NETWORKS. Địa chỉ không tồn tại được nhớ ngắn hạn (negative cache).
+    Trả về: (network, attributes) hoặc (None, None).
+    """
+    cached_network = _get_cached_token_network(address)
+    if cached_network == "": return None, None
+
+    all_definitive = True
+    if cached_network:
+        attrs, definitive = _fetch_token_attributes(cached_network, address, include_top_pools)
+        if attrs: return cached_network, attrs
+        # Lỗi tạm thời (429, 5xx, timeout): không dò các mạng khác, tránh dồn thêm request đúng lúc bị giới hạn.
+        if not definitive: return None, None
+
+    # Dò các mạng còn lại song song; khi nhiều mạng cùng khớp vẫn giữ thứ tự ưu tiên của AUTO_SEARCH_NETWORKS.
+    networks = [n for n in AUTO_SEARCH_NETWORKS if n != cached_network]
+    futures = {_get_probe_executor().submit(_fetch_token_attributes, n, address, include_top_pools): n for n in networks}
+    pending, results = set(futures), {}
+    try:
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done: results[futures[future]] = future.result()
+            for network in networks:
+                if network not in results: break  # Mạng ưu tiên cao hơn chưa trả lời
+                attrs, _ = results[network]
+                if attrs:
+                    _set_cached_token_network(address, network)
+                    return network, attrs
+    finally:
+        for future in pending: future.cancel()
+    all_definitive = all_definitive and all(definitive for _, definitive in results.values())
+
+    # Chỉ ghi negative cache khi mọi mạng đều trả lời rõ ràng là không có (không tính lỗi mạng/429).
+    if all_definitive: _set_cached_token_network(address, None)
+    return None, None
+
 def get_token_details_by_contract(address: str) -> dict | None:
-    for network in AUTO_SEARCH_NETWORKS:
-        url = f"https://api.geckoterminal.com/api/v2/networks/{network}/tokens/{address}"
-        try:
-            res = requests.get(url, headers={"accept": "application/json"}, timeout=10)
-            if res.status_code == 200:
-                data = res.json().get('data', {}).get('attributes', {})
-                name = data.get('name')
-                if name:
-                    price_str = data.get('price_usd')
-                    price = float(price_str) if price_str is not None else 0.0
-                    return {
-                        "price": price,
-                        "network": network,
-                        "symbol": data.get('symbol', 'N/A'),
-                        "name": name
-                    }
-        except requests.RequestException:
-            continue
-    return None
+    network, data = find_token_network(address)
+    if not data: return None
+    price_str = data.get('price_usd')
+    price = float(price_str) if price_str is not None else 0.0
+    return {
+        "price": price,
+        "network": network,
+        "symbol": data.get('symbol', 'N/A'),
+        "name": data['name']
+    }
 
-def check_price_alerts():
-    if not kv: print("Price Alert check skipped due to no DB connection."); return
-    all_alerts_raw = kv.hgetall("price_alerts")
-    for key, alert_json in all_alerts_raw.items():
-        try:
-            alert = json.loads(alert_json)
-            address = alert['address']; network = alert['network']; chat_id = alert['chat_id']
-            threshold = alert['threshold_percent']; ref_price = alert['reference_price']
-            
-            token_info = get_token_details_by_contract(address)
-            
-            if not token_info: continue
-            
-            current_price = token_info['price']
-            
-            price_change_pct = ((current_price - ref_price) / ref_price) * 100 if ref_price > 0 else 0
-            
-            if abs(price_change_pct) >= threshold:
-                emoji = "📈" if price_change_pct > 0 else "📉"
-                name = alert.get('name', address)
-                symbol = alert.get('symbol', 'Token')
-                
-                message = (f"🚨 *Cảnh báo giá cho {name} (${symbol})!*\n\n"
-                           f"Mạng: *{network.upper()}*\n\n"
-                           f"{emoji} Giá đã thay đổi *{price_change_pct:+.2f}%*\n"
-                           f"Giá cũ: `${ref_price:,.4f}`\n"
-                           f"Giá mới: *`${current_price:,.4f}`*")
-                
-                send_telegram_message(chat_id, text=message)
-                
-                alert['reference_price'] = current_price
-                kv.hset("price_alerts", key, json.dumps(alert))
+_multi_price_executor = None
+
+def _get_multi_price_executor() -> ThreadPoolExecutor:
+    global _multi_price_executor
+    if _multi_price_executor is None:
+        _multi_price_executor = ThreadPoolExecutor(max_workers=GECKOTERMINAL_MULTI_CONCURRENCY, thread_name_prefix="multi-price")
+    return _multi_price_executor
+
+def _fetch_token_prices_chunk(network: str, chunk: list[str]) -> tuple[dict, str | None]:
+    """
+    Một lần gọi `tokens/multi` cho tối đa GECKOTERMINAL_MULTI_LIMIT địa chỉ.
+    Trả về: ({address_lower: {'price': float, 'symbol': str}}, thông báo lỗi hoặc None).
+    """
+    url = f"{GECKOTERMINAL_API_BASE}/networks/{network}/tokens/multi/{','.join(chunk)}"
+    try:
+        res = http_request('geckoterminal', 'GET', url, headers={"accept": "application/json"}, timeout=15)
+        if res.status_code != 200:
+            print(f"GeckoTerminal multi API error ({network}): {res.status_code}")
+            return {}, f"❌ Lỗi mạng {network}: API trả về {res.status_code}"
+        price_map = {}
+        for token_data in res.json().get('data', []):
+            attrs = token_data.get('attributes', {})
+            price_map[attrs.get('address', '').lower()] = {
+                'price': float(attrs.get('price_usd') or 0),
+                'symbol': attrs.get('symbol', 'N/A')
+            }
+        return price_map, None
+    except (requests.RequestException, ValueError) as e:
+        print(f"Error fetching GeckoTerminal multi prices ({network}): {e}")
+        return {}, f"🔌 Lỗi kết nối khi check mạng {network}"
+
+def get_token_prices_by_network(addresses_by_network: dict) -> tuple[dict, dict]:
+    """
+    Lấy giá token trên nhiều mạng bằng `tokens/multi`: địa chỉ trùng (không phân biệt hoa thường) chỉ hỏi một lần,
+    mỗi mạng được chia nhóm theo GECKOTERMINAL_MULTI_LIMIT và mọi nhóm của mọi mạng được gọi song song
+    (tối đa GECKOTERMINAL_MULTI_CONCURRENCY request), nên thời gian chờ gần bằng một lượt gọi.
+    Trả về: ({(network, address_lower): {'price', 'symbol'}}, {(network, address_lower): thông báo lỗi của nhóm}).
+    """
+    chunks = []
+    for network, addresses in addresses_by_network.items():
+        unique = list({address.lower(): address for address in addresses}.values())
+        chunks += [(network, unique[i:i + GECKOTERMINAL_MULTI_LIMIT]) for i in range(0, len(unique), GECKOTERMINAL_MULTI_LIMIT)]
+
+    if len(chunks) == 1: results = [_fetch_token_prices_chunk(*chunks[0])]
+    else: results = list(_get_multi_price_executor().map(lambda c: _fetch_token_prices_chunk(*c), chunks))
+
+    prices, failures = {}, {}
+    for (network, chunk), (price_map, error) in zip(chunks, results):
+        for address, info in price_map.items(): prices[(network, address)] = info
+        if error:
+            for address in chunk: failures[(network, address.lower())] = error
+    return prices, failures
+
+# --- CRON CÓ GIỚI HẠN THỜI GIAN, CHIA SHARD ---
+# Dữ liệu của mỗi cron được chia thành CRON_SHARDS shard theo crc32 của chat_id (hoặc key cảnh báo). Một lần gọi
+# lần lượt nhận lease `cron_lease:{job}:{shard}` (SET NX có TTL, kèm fencing token tăng dần) rồi xử lý shard đó;
+# shard đang bị lần gọi khác giữ (hoặc vừa chạy hết vòng trong CRON_SHARD_REST giây) thì bỏ qua, nên nhiều request
+# cron chạy chồng nhau chia nhau công việc thay vì làm trùng. Các lần ghi quyết định việc gửi (con trỏ, trạng thái đã nhắc, giá tham chiếu) chỉ có hiệu lực khi
+# token còn khớp lease: lần chạy đã mất lease dừng lại trước khi gửi.
+# Trong mỗi shard, công việc chạy theo lượt CRON_BATCH_SIZE mục trong CRON_TIME_BUDGET giây. Hết giờ thì lưu con trỏ
+# vào `cron_cursor:{job}:{shard}` và báo phần còn lại; lần gọi sau chạy tiếp từ con trỏ, nên dù dữ liệu lớn tới đâu
+# mọi mục vẫn được xét sau một số lần chạy hữu hạn. Con trỏ bị xoá khi đi hết một vòng.
+_CRON_ACQUIRE_LEASE_LUA = """
+local current = redis.call('GET', KEYS[1])
+if current == 'rest' then return -1 end
+if current then return 0 end
+local token = redis.call('INCR', KEYS[2])
+redis.call('SET', KEYS[1], token, 'PX', ARGV[1])
+return token
+"""
+_CRON_RELEASE_LEASE_LUA = """
+if redis.call('GET', KEYS[1]) ~= ARGV[1] then return 0 end
+if ARGV[2] ~= '0' then
+    redis.call('DEL', KEYS[2])
+    return redis.call('SET', KEYS[1], 'rest', 'EX', ARGV[2])
+end
+return redis.call('DEL', KEYS[1])
+"""
+_CRON_FENCED_SET_LUA = """
+if redis.call('GET', KEYS[1]) ~= ARGV[1] then return 0 end
+for i = 2, #KEYS do
+    redis.call('SET', KEYS[i], ARGV[2 * i - 2], 'EX', ARGV[2 * i - 1])
+end
+return 1
+"""
+_FIRE_PRICE_ALERTS_LUA = """
+if redis.call('GET', KEYS[1]) ~= ARGV[1] then return 0 end
+local applied = {1}
+for i = 0, (#KEYS - 2) / 2 - 1 do
+    local field, upper, lower = ARGV[2 + i * 5], ARGV[5 + i * 5], ARGV[6 + i * 5]
+    if redis.call('HGET', KEYS[2], field) ~= ARGV[3 + i * 5] then
+        applied[#applied + 1] = 0
+    else
+        redis.call('HSET', KEYS[2], field, ARGV[4 + i * 5])
+        if upper == '' then
+            redis.call('ZREM', KEYS[3 + i * 2], field)
+            redis.call('ZREM', KEYS[4 + i * 2], field)
+        else
+            redis.call('ZADD', KEYS[3 + i * 2], upper, field)
+            redis.call('ZADD', KEYS[4 + i * 2], lower, field)
+        end
+        applied[#applied + 1] = 1
+    end
+end
+return applied
+"""
+
+class _LeaseLost(Exception):
+    """Lease của shard đã hết hạn và có thể đã bị lần chạy khác nhận."""
+
+class _CronPass:
+    def __init__(self, job: str, shard: int, deadline: float):
+        self.job, self.shard, self.deadline = job, shard, deadline
+        self.lease_key, self.cursor_key = f"cron_lease:{job}:{shard}", f"cron_cursor:{job}:{shard}"
+        self.reserve = min(TELEGRAM_SEND_TIME_BUDGET, CRON_TIME_BUDGET / 4)  # Giữ lại cho việc gửi tin của lượt cuối
+        self.token, self.cursor, self.counts = None, None, {}
+
+    def acquire(self) -> str:
+        """Nhận lease. Trả về: 'acquired', 'busy' (lần chạy khác đang giữ) hoặc 'rest' (vừa chạy hết vòng)."""
+        token = _run_lua('cron_acquire', _CRON_ACQUIRE_LEASE_LUA, [self.lease_key, f"cron_fence:{self.job}:{self.shard}"],
+                         [int(CRON_LEASE_TTL * 1000)])
+        if token == -1: return 'rest'
+        if not token: return 'busy'
+        self.token = str(token)
+        raw = kv.get(self.cursor_key)
+        try: self.cursor = json.loads(raw) if raw else None
+        except ValueError: self.cursor = None
+        return 'acquired'
+
+    def release(self, complete: bool):
+        """
+        Trả lease (chỉ khi còn giữ). Shard đã đi hết một vòng thì xoá con trỏ và nghỉ CRON_SHARD_REST giây,
+        để lần gọi chồng lên ngay sau không chạy lại từ đầu.
+        """
+        rest = max(CRON_SHARD_REST, 1) if complete else 0
+        _run_lua('cron_release', _CRON_RELEASE_LEASE_LUA, [self.lease_key, self.cursor_key], [self.token, rest])
+
+    def owns(self, value) -> bool:
+        # Các shard dùng chung một chỉ mục và tự lọc mục của mình: mỗi shard đọc toàn bộ chỉ mục, nên lượng đọc Redis
+        # tăng theo CRON_SHARDS. Đổi lại số shard đổi được bất kỳ lúc nào mà không phải chia lại dữ liệu.
+        return zlib.crc32(str(value).encode()) % CRON_SHARDS == self.shard
+
+    def share(self, total: int) -> int:
+        """Ước lượng phần của shard này trong `total` mục chưa duyệt của chỉ mục dùng chung (hash chia đều)."""
+        return -(-max(total, 0) // CRON_SHARDS)
+
+    def remaining_time(self) -> float:
+        return max(0.0, self.deadline - time.monotonic())
 
+    def out_of_time(self) -> bool:
+        return self.remaining_time() <= self.reserve
+
+    def send_budget(self) -> float:
+        return max(1.0, min(TELEGRAM_SEND_TIME_BUDGET, self.remaining_time()))
+
+    def count(self, name: str, value: int):
+        self.counts[name] = self.counts.get(name, 0) + value
+
+    def fenced(self, name: str, source: str, keys: list, args: list):
+        """Chạy script Lua kiểm tra KEYS[1] (lease) == ARGV[1] (token) trước khi ghi; ném _LeaseLost nếu không còn giữ."""
+        result = _run_lua(name, source, [self.lease_key] + keys, [self.token] + args)
+        if not result: raise _LeaseLost(self.lease_key)
+        return result
+
+    def fenced_set(self, values: dict):
+        """SET các key {key: (value, ttl)} nếu còn giữ lease."""
+        keys, args = [], []
+        for key, (value, ttl) in values.items(): keys.append(key); args += [value, ttl]
+        self.fenced('cron_fenced_set', _CRON_FENCED_SET_LUA, keys, args)
+
+    def save(self, cursor: dict):
+        self.fenced_set({self.cursor_key: (json.dumps(cursor), CRON_CURSOR_TTL)})
+        self.cursor = cursor
+
+def run_cron_shards(job: str, run_shard, counters: tuple = ()) -> dict:
+    """
+    Chạy `run_shard(cron)` cho từng shard còn trống tới khi hết CRON_TIME_BUDGET, bắt đầu từ một shard ngẫu nhiên
+    để các lần gọi song song ít tranh nhau. `run_shard` trả về (đã hết vòng?, số mục còn lại) và đếm qua `cron.count`.
+    """
+    deadline = time.monotonic() + CRON_TIME_BUDGET
+    flush_telegram_outbox(min(TELEGRAM_SEND_TIME_BUDGET, CRON_TIME_BUDGET / 4))
+    start = int.from_bytes(os.urandom(2), 'big') % CRON_SHARDS
+    totals, remaining = dict.fromkeys(counters, 0), 0
+    shards = {'complete': [], 'partial': [], 'busy': [], 'rest': [], 'pending': [], 'lost': []}
+    for shard in [(start + i) % CRON_SHARDS for i in range(CRON_SHARDS)]:
+        cron = _CronPass(job, shard, deadline)
+        if cron.out_of_time(): shards['pending'].append(shard); continue
+        lease = cron.acquire()
+        if lease != 'acquired': shards[lease].append(shard); continue
+        complete = False
+        try:
+            complete, shard_remaining = run_shard(cron)
+            shards['complete' if complete else 'partial'].append(shard)
+            if not complete: remaining += max(shard_remaining, 0)
+        except _LeaseLost:
+            print(f"[{job}] Lost lease on shard {shard}, stopping it.")
+            shards['lost'].append(shard)
+        finally:
+            cron.release(complete)
+        for name, value in cron.counts.items(): totals[name] = totals.get(name, 0) + value
+
+    for result, shard_list in shards.items():
+        if shard_list: inc_metric('bot_cron_passes_total', len(shard_list), job=job, result=result)
+    complete = not (shards['partial'] or shards['pending'] or shards['lost'])
+    result = {'complete': complete, 'remaining': remaining, 'shards': {k: v for k, v in shards.items() if v}, **totals}
+    print(f"[{job}] {result}")
+    return result
+
+def _check_price_alert_tokens(tokens: list[str], cron: _CronPass):
+    """Định giá một lượt token ("network|address") rồi chỉ đọc những cảnh báo có ngưỡng bị giá mới vượt qua."""
+    addresses_by_network = {}
+    for token in tokens:
+        network, address = token.split('|', 1)
+        addresses_by_network.setdefault(network, []).append(address)
+    cron.count('tokens_checked', len(tokens))
+    if not tokens: return
+    prices, _ = get_token_prices_by_network(addresses_by_network)
+    priced = [(network, address, info['price']) for (network, address), info in prices.items()]
+
+    # Cảnh báo kích hoạt khi giá >= giá trên hoặc <= giá dưới; script chỉ trả về các cảnh báo bị vượt ngưỡng.
+    band_keys = [key for network, address, _ in priced for key in _alert_band_keys(network, address)]
+    result = _run_lua('crossed_alerts', _CROSSED_PRICE_ALERTS_LUA, band_keys, [price for _, _, price in priced]) if priced else []
+    crossed = {alert_key: priced[int(index) - 1] for index, alert_key in zip(result[::2], result[1::2])}
+    if not crossed: return
+
+    outgoing, fired, stale = [], [], []
+    for (key, (network, address, current_price)), alert_json in zip(crossed.items(), kv.hmget(PRICE_ALERTS_KEY, list(crossed))):
+        try:
+            alert = json.loads(alert_json) if alert_json else None
+            if not alert or alert['network'] != network or alert['address'].lower() != address:
+                stale.append((key, network, address)); continue  # Cảnh báo đã xoá hoặc đổi mạng
+            chat_id, ref_price = alert['chat_id'], alert['reference_price']
         except (json.JSONDecodeError, KeyError) as e:
             print(f"Error processing price alert for key {key}: {e}")
             continue
 
+        price_change_pct = ((current_price - ref_price) / ref_price) * 100 if ref_price > 0 else 0
+        emoji = "📈" if price_change_pct > 0 else "📉"
+        name = alert.get('name', address)
+        symbol = alert.get('symbol', 'Token')
+
+        message = (f"🚨 *Cảnh báo giá cho {name} (${symbol})!*\n\n"
+                   f"Mạng: *{network.upper()}*\n\n"
+                   f"{emoji} Giá đã thay đổi *{price_change_pct:+.2f}%*\n"
+                   f"Giá cũ: `${ref_price:,.4f}`\n"
+                   f"Giá mới: *`${current_price:,.4f}`*")
+        outgoing.append({'chat_id': chat_id, 'text': message})
+
+        alert['reference_price'] = current_price
+        fired.append((key, alert_json, alert))
+
+    if stale:
+        # Gỡ dải giá mồ côi; token không còn cảnh báo nào thì bỏ khỏi tập token để không bị định giá mỗi lượt.
+        keys, args = [PRICE_ALERTS_TOKENS_KEY], []
+        for key, network, address in stale:
+            keys += _alert_band_keys(network, address)
+            args += [key, f"{network}|{address}"]
+        _run_lua('drop_stale_bands', _DROP_STALE_ALERT_BANDS_LUA, keys, args)
+
+    # Chỉ các cảnh báo vừa kích hoạt được ghi lại (giá tham chiếu và hai ngưỡng mới), có fencing và trước khi gửi:
+    # lần chạy đã mất lease dừng ở đây. Cảnh báo bị /unalert hoặc sửa trong lúc đó được bỏ qua, không tạo lại.
+    if fired:
+        keys, args = [PRICE_ALERTS_KEY], []
+        for key, alert_json, alert in fired:
+            bands = _alert_bands(alert)
+            keys += _alert_band_keys(alert['network'], alert['address'].lower())
+            args += [key, alert_json, json.dumps(alert), *(bands if bands else ('', ''))]
+        applied = cron.fenced('fire_alerts', _FIRE_PRICE_ALERTS_LUA, keys, args)[1:]
+        outgoing = [message for message, ok in zip(outgoing, applied) if ok]
+    cron.count('alerts_fired', len(outgoing))
+    cron.count('notifications_sent', sum(1 for result in send_telegram_messages(outgoing, cron.send_budget()) if result['status'] == 'sent'))
+
+def _check_price_alerts_shard(cron: _CronPass) -> tuple[bool, int]:
+    # Con trỏ: vị trí SSCAN trong PRICE_ALERTS_TOKENS_KEY và số token đã duyệt trong vòng hiện tại.
+    state = cron.cursor or {'cursor': 0, 'done': 0}
+    while not cron.out_of_time():
+        next_cursor, tokens = kv.sscan(PRICE_ALERTS_TOKENS_KEY, state['cursor'], count=CRON_BATCH_SIZE)
+        _check_price_alert_tokens([token for token in tokens if cron.owns(token)], cron)
+        state = {'cursor': int(next_cursor), 'done': state['done'] + len(tokens)}
+        if state['cursor'] == 0: return True, 0
+        cron.save(state)
+    return False, cron.share(kv.scard(PRICE_ALERTS_TOKENS_KEY) - state['done'])
+
+def check_price_alerts() -> dict:
+    if not kv: print("Price Alert check skipped due to no DB connection."); return {}
+    band_index_ready, chat_index_ready = kv.mget(PRICE_ALERTS_BAND_INDEX_READY_KEY, PRICE_ALERTS_CHAT_INDEX_READY_KEY)
+    if not band_index_ready: _ensure_alert_band_index()
+    if not chat_index_ready: _ensure_chat_alert_index()
+    return run_cron_shards('check_alerts', _check_price_alerts_shard, ('tokens_checked', 'alerts_fired', 'notifications_sent'))
+
 def is_evm_address(s: str) -> bool: return isinstance(s, str) and s.startswith('0x') and len(s) == 42
 def is_tron_address(s: str) -> bool: return isinstance(s, str) and s.startswith('T') and len(s) == 34
 def is_crypto_address(s: str) -> bool: return is_evm_address(s) or is_tron_address(s)
 
 def send_telegram_message(chat_id, text, **kwargs) -> int | None:
-    url = f"https://api.telegram.org/bot{BOT_TOKEN}/sendMessage"
+    url = f"{TELEGRAM_API_BASE}/bot{BOT_TOKEN}/sendMessage"
     payload = {'chat_id': chat_id, 'text': text, 'parse_mode': 'Markdown', **kwargs}
     try:
-        response = requests.post(url, json=payload, timeout=10)
+        response = http_request('telegram', 'POST', url, json=payload)
         if response.status_code == 200 and response.json().get('ok'): return response.json().get('result', {}).get('message_id')
         print(f"Error sending message, response: {response.text}"); return None
     except requests.RequestException as e: print(f"Error sending message: {e}"); return None
 
 def pin_telegram_message(chat_id, message_id):
-    url = f"https://api.telegram.org/bot{BOT_TOKEN}/pinChatMessage"
+    url = f"{TELEGRAM_API_BASE}/bot{BOT_TOKEN}/pinChatMessage"
     payload = {'chat_id': chat_id, 'message_id': message_id, 'disable_notification': False}
     try:
-        response = requests.post(url, json=payload, timeout=10)
+        response = http_request('telegram', 'POST', url, json=payload)
         if response.status_code != 200: print(f"Error pinning message: {response.text}")
     except requests.RequestException as e: print(f"Error pinning message: {e}")
 
-def edit_telegram_message(chat_id, msg_id, text, **kwargs):
-    url = f"https://api.telegram.org/bot{BOT_TOKEN}/editMessageText"
-    payload = {'chat_id': chat_id, 'message_id': msg_id, 'text': text, 'parse_mode': 'Markdown', **kwargs}
-    try: requests.post(url, json=payload, timeout=10)
-    except requests.RequestException as e: print(f"Error editing message: {e}")
-
-def answer_callback_query(cb_id):
-    url = f"https://api.telegram.org/bot{BOT_TOKEN}/answerCallbackQuery"
-    try: requests.post(url, json={'callback_query_id': cb_id}, timeout=5)
+def edit_telegram_message(chat_id, msg_id, text, **kwargs) -> bool:
+    """Sửa nội dung tin nhắn (tham số bằng None bị bỏ, ví dụ `parse_mode=None` để gửi dạng thuần). Trả về True nếu thành công."""
+    url = f"{TELEGRAM_API_BASE}/bot{BOT_TOKEN}/editMessageText"
+    payload = {k: v for k, v in {'chat_id': chat_id, 'message_id': msg_id, 'text': text, 'parse_mode': 'Markdown', **kwargs}.items() if v is not None}
+    try:
+        response = http_request('telegram', 'POST', url, json=payload)
+        if response.status_code == 200: return True
+        print(f"Error editing message, response: {response.text}"); return False
+    except requests.RequestException as e: print(f"Error editing message: {e}"); return False
+
+def answer_callback_query(cb_id, text: str | None = None):
+    url = f"{TELEGRAM_API_BASE}/bot{BOT_TOKEN}/answerCallbackQuery"
+    payload = {'callback_query_id': cb_id, **({'text': text} if text else {})}
+    try: http_request('telegram', 'POST', url, json=payload, timeout=5)
     except requests.RequestException as e: print(f"Error answering callback: {e}")
 
 def delete_telegram_message(chat_id, message_id):
-    url = f"https://api.telegram.org/bot{BOT_TOKEN}/deleteMessage"
+    url = f"{TELEGRAM_API_BASE}/bot{BOT_TOKEN}/deleteMessage"
     payload = {'chat_id': chat_id, 'message_id': message_id}
-    try: requests.post(url, json=payload, timeout=5)
+    try: http_request('telegram', 'POST', url, json=payload, timeout=5)
     except requests.RequestException as e: print(f"Error deleting message: {e}")
 
-def find_token_across_networks(address: str) -> str:
-    for network in AUTO_SEARCH_NETWORKS:
-        url = f"https://api.geckoterminal.com/api/v2/networks/{network}/tokens/{address}?include=top_pools"
+# --- HÀNG ĐỢI GỬI TIN HÀNG LOẠT (CRON) ---
+class _TokenBucket:
+    """Token bucket đơn giản, an toàn đa luồng. `reserve()` giữ chỗ một token và trả về số giây phải chờ."""
+    def __init__(self, rate: float, capacity: float):
+        self.rate, self.capacity = rate, capacity
+        self.tokens, self.last = capacity, time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self) -> float:
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= 1
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def try_acquire(self) -> bool:
+        """Lấy một token nếu có sẵn ngay; không giữ chỗ khi phải chờ."""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            if self.tokens < 1: return False
+            self.tokens -= 1
+            return True
+
+_global_send_bucket = _TokenBucket(TELEGRAM_GLOBAL_RATE, 5)
+_chat_send_buckets = {}
+_chat_send_buckets_lock = threading.Lock()
+
+def _get_chat_send_bucket(chat_id) -> _TokenBucket:
+    with _chat_send_buckets_lock:
+        bucket = _chat_send_buckets.get(str(chat_id))
+        if bucket is None:
+            if len(_chat_send_buckets) > 10000: _chat_send_buckets.clear()
+            # Cho phép gửi ngay một đợt nhỏ, sau đó giữ đúng tốc độ 20 tin/phút.
+            bucket = _chat_send_buckets[str(chat_id)] = _TokenBucket(TELEGRAM_PER_CHAT_RATE, 3)
+        return bucket
+
+def _post_telegram_message(message: dict) -> tuple[int | None, float | None, bool]:
+    """
+    Gửi một tin trong hàng đợi. Trả về: (message_id, retry_after, lỗi vĩnh viễn).
+    Lỗi 4xx khác 429 (bot bị kick, chat không tồn tại...) được coi là vĩnh viễn, không thử lại.
+    """
+    url = f"{TELEGRAM_API_BASE}/bot{BOT_TOKEN}/sendMessage"
+    payload = {'parse_mode': 'Markdown', **{k: v for k, v in message.items() if k != 'attempts'}}
+    try:
+        response = http_request('telegram_bulk', 'POST', url, json=payload)
+        body = response.json() if response.content else {}
+        if response.status_code == 200 and body.get('ok'): return body.get('result', {}).get('message_id'), None, False
+        if response.status_code == 429:
+            return None, float((body.get('parameters') or {}).get('retry_after') or response.headers.get('Retry-After') or 1), False
+        print(f"Error sending queued message to {message.get('chat_id')}, response: {response.text}")
+        return None, None, 400 <= response.status_code < 500
+    except (requests.RequestException, ValueError) as e:
+        print(f"Error sending queued message to {message.get('chat_id')}: {e}")
+        return None, None, False
+
+class _ProgressiveEditor:
+    """
+    Sửa dần tin nhắn tạm theo nội dung LLM đang sinh (dùng làm `on_progress`). Mỗi lần sửa cách nhau ít nhất
+    LLM_STREAM_EDIT_INTERVAL giây, cần token của bucket theo chat và bị bỏ qua khi nội dung chưa đổi.
+    Bản nháp gửi dạng thuần vì Markdown đang sinh dở có thể chưa đóng thẻ; lần sửa cuối do người gọi thực hiện.
+    """
+    def __init__(self, chat_id, msg_id, command: str):
+        self.chat_id, self.msg_id, self.command = chat_id, msg_id, command
+        self.started_at = time.monotonic()
+        self.next_edit_at, self.last_text = 0.0, None
+
+    def __call__(self, text: str):
+        now = time.monotonic()
+        if now < self.next_edit_at: return
+        text = text.strip()
+        if not text or text == self.last_text: return
+        if not _get_chat_send_bucket(self.chat_id).try_acquire():
+            self.next_edit_at = now + LLM_STREAM_EDIT_INTERVAL / 2; return
+
+        if self.last_text is None:
+            observe_metric('bot_llm_first_edit_seconds', now - self.started_at, command=self.command)
+        url = f"{TELEGRAM_API_BASE}/bot{BOT_TOKEN}/editMessageText"
+        payload = {'chat_id': self.chat_id, 'message_id': self.msg_id, 'text': text[:LLM_STREAM_PREVIEW_CHARS] + " ▌"}
+        retry_after = 0.0
         try:
-            res = requests.get(url, headers={"accept": "application/json"}, timeout=10)
-            if res.status_code == 200:
-                data = res.json()
-                token_attr = data.get('data', {}).get('attributes', {})
-                if not token_attr: continue
-                price_str = token_attr.get('price_usd')
-                price = float(price_str) if price_str is not None else 0.0
-                change_pct_str = token_attr.get('price_change_percentage', {}).get('h24')
-                change = float(change_pct_str) if change_pct_str is not None else 0.0
-                return (f"✅ *Tìm thấy trên mạng {network.upper()}*\n"
-                        f"*{token_attr.get('name', 'N/A')} ({token_attr.get('symbol', 'N/A')})*\n\n"
-                        f"Giá: *${price:,.8f}*\n24h: *{'📈' if change >= 0 else '📉'} {change:+.2f}%*\n\n"
-                        f"🔗 [Xem trên GeckoTerminal](https://www.geckoterminal.com/{network}/tokens/{address})\n\n`{address}`")
-        except requests.RequestException:
-            continue
-    return f"❌ Không tìm thấy token với địa chỉ `{address[:10]}...`."
+            response = http_request('telegram_bulk', 'POST', url, json=payload)
+            if response.status_code == 429:
+                body = response.json() if response.content else {}
+                retry_after = float((body.get('parameters') or {}).get('retry_after') or response.headers.get('Retry-After') or 1)
+        except (requests.RequestException, ValueError) as e:
+            print(f"Error editing streamed message: {e}")
+        self.last_text = text
+        self.next_edit_at = time.monotonic() + max(LLM_STREAM_EDIT_INTERVAL, retry_after)
+
+def _persist_outbox(messages: list[dict], retry_after: float | None = None):
+    """Lưu các tin chưa gửi được vào Redis để lần cron sau gửi lại."""
+    if not kv or not messages: return
+    pipe = kv.pipeline(transaction=False)
+    for message in messages:
+        message = {**message, 'attempts': message.get('attempts', 0) + 1}
+        if message['attempts'] > OUTBOX_MAX_ATTEMPTS:
+            print(f"Dropping message to {message.get('chat_id')} after {OUTBOX_MAX_ATTEMPTS} attempts."); continue
+        # Nonce giữ cho các tin giống hệt nhau không bị gộp thành một phần tử ZSET.
+        member = json.dumps({'nonce': os.urandom(6).hex(), 'message': message})
+        pipe.zadd(OUTBOX_RETRY_KEY, {member: datetime.now().timestamp() + (retry_after or 30 * message['attempts'])})
+    pipe.execute()
+
+def _deliver_chat_messages(items: list[tuple[int, dict]], deadline: float) -> list[tuple[int, str, int | None]]:
+    """Gửi lần lượt các tin của một chat (giữ thứ tự), tôn trọng token bucket và retry_after của Telegram."""
+    results = []
+    chat_bucket = _get_chat_send_bucket(items[0][1]['chat_id'])
+    for position, (index, message) in enumerate(items):
+        inline_retries = 0
+        while True:
+            delay = max(chat_bucket.reserve(), _global_send_bucket.reserve())
+            if time.monotonic() + delay > deadline:
+                remaining = items[position:]
+                _persist_outbox([m for _, m in remaining])
+                return results + [(i, 'queued', None) for i, _ in remaining]
+            if delay: time.sleep(delay)
+            message_id, retry_after, permanent = _post_telegram_message(message)
+            if message_id:
+                results.append((index, 'sent', message_id)); break
+            if permanent:
+                results.append((index, 'failed', None)); break
+            if retry_after and inline_retries < 2 and time.monotonic() + retry_after < deadline:
+                inline_retries += 1; time.sleep(retry_after); continue
+            _persist_outbox([message], retry_after)
+            results.append((index, 'queued', None)); break
+    return results
+
+def send_telegram_messages(messages: list[dict], time_budget: float = TELEGRAM_SEND_TIME_BUDGET) -> list[dict]:
+    """
+    Gửi hàng loạt tin nhắn (mỗi phần tử là payload `sendMessage`: chat_id, text, ...) với giới hạn tốc độ
+    toàn cục và theo từng chat, chạy song song tới TELEGRAM_SEND_CONCURRENCY luồng.
+    Tin bị 429 hoặc lỗi tạm thời mà không kịp gửi trong `time_budget` được lưu vào OUTBOX_RETRY_KEY.
+    Token bucket nằm trong bộ nhớ tiến trình nên chỉ giới hạn trong một instance.
+    Trả về: danh sách {'status': 'sent' | 'queued' | 'failed', 'message_id': ...} theo thứ tự đầu vào.
+    """
+    if not messages: return []
+    deadline = time.monotonic() + time_budget
+    by_chat = {}
+    for index, message in enumerate(messages):
+        by_chat.setdefault(str(message['chat_id']), []).append((index, message))
+
+    results = [None] * len(messages)
+    with ThreadPoolExecutor(max_workers=min(TELEGRAM_SEND_CONCURRENCY, len(by_chat)), thread_name_prefix="telegram-send") as executor:
+        for future in [executor.submit(_deliver_chat_messages, items, deadline) for items in by_chat.values()]:
+            for index, status, message_id in future.result():
+                results[index] = {'status': status, 'message_id': message_id}
+    return results
+
+def flush_telegram_outbox(time_budget: float = TELEGRAM_SEND_TIME_BUDGET, limit: int = 500) -> int:
+    """Gửi lại các tin đã đến hạn trong OUTBOX_RETRY_KEY. Trả về số tin gửi thành công."""
+    if not kv: return 0
+    members = kv.zrangebyscore(OUTBOX_RETRY_KEY, '-inf', datetime.now().timestamp(), start=0, num=limit)
+    if not members: return 0
+    # ZREM từng phần tử để hai lần cron chồng nhau không cùng nhận một tin.
+    pipe = kv.pipeline(transaction=False)
+    for member in members: pipe.zrem(OUTBOX_RETRY_KEY, member)
+    claimed = [json.loads(member)['message'] for member, removed in zip(members, pipe.execute()) if removed]
+    results = send_telegram_messages(claimed, time_budget)
+    return sum(1 for r in results if r['status'] == 'sent')
 
-def process_portfolio_text(message_text: str) -> str | None:
-    lines = message_text.strip().split('\n')
-    
-    # 1. Gom nhóm token theo network để gọi API 1 lần (Batching)
-    # Cấu trúc: {'bsc': [{'addr': '0x...', 'amount': 100}, ...], 'base': [...]}
-    network_groups = {}
-    valid_lines_count = 0
-    
-    for line in lines:
+def find_token_across_networks(address: str) -> str:
+    network, token_attr = find_token_network(address, include_top_pools=True)
+    if not token_attr:
+        return f"❌ Không tìm thấy token với địa chỉ `{address[:10]}...`."
+    price_str = token_attr.get('price_usd')
+    price = float(price_str) if price_str is not None else 0.0
+    change_pct_str = (token_attr.get('price_change_percentage') or {}).get('h24')
+    change = float(change_pct_str) if change_pct_str is not None else 0.0
+    return (f"✅ *Tìm thấy trên mạng {network.upper()}*\n"
+            f"*{token_attr.get('name', 'N/A')} ({token_attr.get('symbol', 'N/A')})*\n\n"
+            f"Giá: *${price:,.8f}*\n24h: *{'📈' if change >= 0 else '📉'} {change:+.2f}%*\n\n"
+            f"🔗 [Xem trên GeckoTerminal](https://www.geckoterminal.com/{network}/tokens/{address})\n\n`{address}`")
+
+def parse_portfolio_lines(message_text: str) -> list[tuple[float, str, str]]:
+    """Các dòng hợp lệ `<số lượng> <địa chỉ> <mạng>` theo thứ tự nhập: [(amount, address, network)]."""
+    items = []
+    for line in message_text.strip().split('\n'):
         parts = line.strip().split()
         if len(parts) != 3: continue
-        
-        try: 
-            amount = float(parts[0])
-        except ValueError: 
-            continue
-            
+        try: amount = float(parts[0])
+        except ValueError: continue
         address, network = parts[1], parts[2].lower()
-        
-        if not is_crypto_address(address):
-            continue
+        if is_crypto_address(address): items.append((amount, address, network))
+    return items
 
-        valid_lines_count += 1
-        
-        if network not in network_groups:
-            network_groups[network] = []
-        network_groups[network].append({'amount': amount, 'address': address})
+def price_portfolio(items: list[tuple[float, str, str]]) -> str | None:
+    """Định giá danh sách (amount, address, network) đã được parse sẵn."""
+    if not items: return None
 
-    if valid_lines_count == 0: return None
+    # 1. Gom địa chỉ theo network; mọi nhóm `tokens/multi` của mọi network được gọi song song.
+    addresses_by_network = {}
+    for _, address, network in items: addresses_by_network.setdefault(network, []).append(address)
+    prices, failures = get_token_prices_by_network(addresses_by_network)
 
+    # 2. Dựng kết quả theo đúng thứ tự dòng nhập; lỗi của một nhóm chỉ báo một lần.
     total_value = 0.0
-    result_lines = []
-
-    # 2. Xử lý từng network (Giảm số lượng request từ N xuống 1)
-    for network, items in network_groups.items():
-        # Lấy danh sách address và nối chuỗi bằng dấu phẩy
-        addresses = [item['address'] for item in items]
-        addresses_str = ",".join(addresses)
-        
-        # Dùng endpoint multi-token của GeckoTerminal
-        url = f"https://api.geckoterminal.com/api/v2/networks/{network}/tokens/multi/{addresses_str}"
-        
-        try:
-            res = requests.get(url, headers={"accept": "application/json"}, timeout=15)
-            
-            if res.status_code == 200:
-                data = res.json().get('data', [])
-                
-                # Tạo map để tra cứu giá nhanh: {address_lower: price_data}
-                price_map = {}
-                for token_data in data:
-                    attrs = token_data.get('attributes', {})
-                    addr = attrs.get('address', '').lower()
-                    price_map[addr] = {
-                        'price': float(attrs.get('price_usd') or 0),
-                        'symbol': attrs.get('symbol', 'N/A')
-                    }
-                
-                # Tính toán dựa trên danh sách input ban đầu
-                for item in items:
-                    addr_key = item['address'].lower()
-                    amount = item['amount']
-                    
-                    if addr_key in price_map:
-                        info = price_map[addr_key]
-                        price = info['price']
-                        symbol = info['symbol']
-                        
-                        if price > 0:
-                            value = amount * price
-                            total_value += value
-                            result_lines.append(f"*{symbol}*: `${price:,.4f}` x {amount} = *${value:,.2f}*")
-                        else:
-                            result_lines.append(f"⚠️ *{symbol}*: Chưa có giá (Liquidity thấp)")
-                    else:
-                        # Trường hợp API trả về OK nhưng không tìm thấy token trong list đó
-                        result_lines.append(f"❌ Không tìm thấy data: `{item['address'][:6]}...`")
-            
+    result_lines, reported_errors = [], set()
+    for amount, address, network in items:
+        key = (network, address.lower())
+        if key in prices:
+            price, symbol = prices[key]['price'], prices[key]['symbol']
+            if price > 0:
+                value = amount * price
+                total_value += value
+                result_lines.append(f"*{symbol}*: `${price:,.4f}` x {amount} = *${value:,.2f}*")
             else:
-                # Lỗi cả network (ví dụ nhập sai tên network)
-                result_lines.append(f"❌ Lỗi mạng {network}: API trả về {res.status_code}")
-
-        except requests.RequestException:
-            result_lines.append(f"🔌 Lỗi kết nối khi check mạng {network}")
+                result_lines.append(f"⚠️ *{symbol}*: Chưa có giá (Liquidity thấp)")
+        elif key in failures:
+            if failures[key] not in reported_errors:
+                reported_errors.add(failures[key]); result_lines.append(failures[key])
+        else:
+            # API trả về OK nhưng không có token này trong danh sách
+            result_lines.append(f"❌ Không tìm thấy data: `{address[:6]}...`")
 
     return "\n".join(result_lines) + f"\n--------------------\n*Tổng: *${total_value:,.2f}**"
 
-# --- WEB SERVER (FLASK) ---
-app = Flask(__name__)
-@app.route('/', methods=['GET', 'POST'])
-def webhook():
-    if request.method == 'GET':
-        return '''
-        <html>
-            <head>
-                <meta name="talentapp:project_verification" content="c6cf868d6d1698cf0b43b101e332f5ad9c891e925c371aaf2ec73ee23198897ce60c79f851d9c67d9ca150e10051c46c3f638f1e7aa18a403e1ce9c977ba3360">
-            </head>
-            <body>TeeBoo Bot Home</body>
-        </html>
-        '''
-    if not BOT_TOKEN: return "Server configuration error", 500
-    data = request.get_json()
+# --- LÀM MỚI DANH MỤC (NÚT 🔄 REFRESH) ---
+# Mỗi tin kết quả (chat, message) chỉ được tính lại tối đa một lần mỗi PORTFOLIO_REFRESH_COOLDOWN giây:
+# các lần bấm trùng trong cùng instance hoặc khác instance đều nhận thông báo thay vì gọi lại GeckoTerminal.
+# Hash nội dung đã gửi được lưu lại để bỏ qua các lần sửa không đổi gì (Telegram trả lỗi "message is not modified").
+# Danh mục đã parse được lưu gọn theo tin kết quả, nên khi refresh không cần đọc lại (và parse lại) tin gốc:
+# vẫn refresh được khi tin gốc dài, bị sửa hay bị xoá.
+PORTFOLIO_REFRESH_COOLDOWN = int(os.getenv("PORTFOLIO_REFRESH_COOLDOWN", "10"))
+PORTFOLIO_MESSAGE_TTL = 7 * 24 * 3600
+_portfolio_refresh_inflight = set()
+_portfolio_refresh_inflight_lock = threading.Lock()
+
+def _portfolio_message_key(chat_id, msg_id) -> str:
+    return f"portfolio_msg:{chat_id}:{msg_id}"
+
+def _text_hash(text: str) -> str:
+    return hashlib.sha256(text.encode()).hexdigest()
+
+def _encode_portfolio(items: list[tuple[float, str, str]]) -> str:
+    """Dạng lưu gọn: {"t": [[network, address], ...] (mỗi token một lần), "i": [[chỉ số token, amount], ...]}."""
+    tokens, items_out = {}, []
+    for amount, address, network in items:
+        items_out.append([tokens.setdefault((network, address), len(tokens)), amount])
+    return json.dumps({"t": [list(token) for token in tokens], "i": items_out}, separators=(',', ':'))
+
+def _decode_portfolio(raw: str) -> list[tuple[float, str, str]]:
+    data = json.loads(raw)
+    return [(amount, data["t"][index][1], data["t"][index][0]) for index, amount in data["i"]]
+
+def remember_portfolio_message(chat_id, msg_id, text: str, items: list[tuple[float, str, str]] | None = None):
+    """Ghi hash nội dung vừa gửi (và danh mục đã parse, nếu có) cho tin kết quả danh mục."""
+    if not kv or not msg_id: return
+    message_key = _portfolio_message_key(chat_id, msg_id)
+    pipe = kv.pipeline(transaction=False)
+    pipe.set(f"{message_key}:sent_hash", _text_hash(text), ex=PORTFOLIO_MESSAGE_TTL)
+    if items: pipe.set(f"{message_key}:items", _encode_portfolio(items), ex=PORTFOLIO_MESSAGE_TTL)
+    pipe.execute()
+
+def refresh_portfolio_message(chat_id, msg_id, portfolio_text: str | None = None, reply_markup=None) -> str:
+    """
+    Tính lại danh mục và sửa tin kết quả nếu nội dung đổi. Các lần bấm trùng nhau dùng chung một lần tính:
+    lần bấm đến sau không tính lại mà nhận kết quả qua chính tin đang được sửa.
+    Danh mục lấy từ bản đã lưu; chỉ khi không có (tin cũ, hết hạn) mới parse lại `portfolio_text` (tin gốc).
+    Trả về: trạng thái ngắn để ghi log (callback đã được trả lời trước khi tính).
+    """
+    inflight_key = (str(chat_id), msg_id)
+    with _portfolio_refresh_inflight_lock:
+        if inflight_key in _portfolio_refresh_inflight: return "đang được cập nhật bởi lần bấm khác"
+        _portfolio_refresh_inflight.add(inflight_key)
+    try:
+        message_key, sent_hash, items = _portfolio_message_key(chat_id, msg_id), None, None
+        if kv:
+            pipe = kv.pipeline(transaction=False)
+            pipe.set(f"{message_key}:cooldown", "1", nx=True, ex=PORTFOLIO_REFRESH_COOLDOWN)
+            pipe.get(f"{message_key}:sent_hash")
+            pipe.getex(f"{message_key}:items", ex=PORTFOLIO_MESSAGE_TTL)
+            acquired, sent_hash, stored_items = pipe.execute()
+            if not acquired: return "trong thời gian chờ giữa hai lần cập nhật"
+            if stored_items:
+                try: items = _decode_portfolio(stored_items)
+                except (ValueError, KeyError, IndexError, TypeError) as e: print(f"Error decoding stored portfolio: {e}")
+
+        parsed_from_text = items is None
+        if parsed_from_text: items = parse_portfolio_lines(portfolio_text or "")
+        result = price_portfolio(items)
+        if not result: return "không đọc được danh mục"
+        result_hash = _text_hash(result)
+        if result_hash == sent_hash:
+            inc_metric('bot_portfolio_refresh_total', result='unchanged')
+            return "giá chưa thay đổi"
+        if not edit_telegram_message(chat_id, msg_id, text=result, reply_markup=reply_markup):
+            return "sửa tin thất bại"
+        inc_metric('bot_portfolio_refresh_total', result='updated')
+        remember_portfolio_message(chat_id, msg_id, result, items if parsed_from_text else None)
+        return "đã cập nhật"
+    finally:
+        with _portfolio_refresh_inflight_lock: _portfolio_refresh_inflight.discard(inflight_key)
+
+# --- HÀNG ĐỢI JOB (WEBHOOK PHẢN HỒI NHANH) ---
+# Khi bật WEBHOOK_ASYNC_MODE, webhook chỉ kiểm tra update, đẩy vào list Redis rồi trả lời Telegram ngay.
+# Worker (endpoint `/drain_jobs` hoặc `python api/index.py worker`) lấy job theo kiểu reliable queue:
+# job được chuyển sang `jobs:processing` kèm lease trong `jobs:leases`; hết hạn lease mà chưa xác nhận
+# thì job được trả lại hàng đợi (tối đa JOB_MAX_ATTEMPTS lần, sau đó vào `jobs:dead`).
+# Mỗi job là chuỗi `<số lần thử>|<update JSON>`: khi trả lại chỉ tăng tiền tố, phần update giữ nguyên từng byte.
+WEBHOOK_ASYNC_MODE = os.getenv("WEBHOOK_ASYNC_MODE", "").lower() in ("1", "true", "yes", "on")
+JOB_DRAIN_URL = os.getenv("JOB_DRAIN_URL")  # Nếu đặt, webhook gọi nhẹ endpoint này để đánh thức worker
+JOB_QUEUE_KEY = "jobs:pending"
+JOB_PROCESSING_KEY = "jobs:processing"
+JOB_LEASES_KEY = "jobs:leases"
+JOB_DEAD_KEY = "jobs:dead"
+JOB_VISIBILITY_TIMEOUT = int(os.getenv("JOB_VISIBILITY_TIMEOUT", "60"))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+JOB_WORKER_CONCURRENCY = int(os.getenv("JOB_WORKER_CONCURRENCY", "4"))
+JOB_DRAIN_TIME_BUDGET = float(os.getenv("JOB_DRAIN_TIME_BUDGET", "50"))
+
+_ENQUEUE_UPDATE_LUA = """
+if redis.call('SET', KEYS[1], '1', 'NX', 'EX', ARGV[2]) then
+    return redis.call('LPUSH', KEYS[2], ARGV[1])
+end
+return 0
+"""
+_CLAIM_JOB_LUA = """
+local raw = redis.call('RPOPLPUSH', KEYS[1], KEYS[2])
+if raw then redis.call('ZADD', KEYS[3], ARGV[1], raw) end
+return raw
+"""
+_ACK_JOB_LUA = """
+if redis.call('ZREM', KEYS[2], ARGV[1]) == 1 then
+    redis.call('LREM', KEYS[1], 1, ARGV[1])
+    return 1
+end
+return 0
+"""
+_REQUEUE_EXPIRED_JOBS_LUA = """
+local expired = redis.call('ZRANGEBYSCORE', KEYS[3], '-inf', ARGV[1])
+for _, raw in ipairs(expired) do
+    redis.call('ZREM', KEYS[3], raw)
+    redis.call('LREM', KEYS[2], 1, raw)
+    local attempts, body = 0, raw
+    if string.sub(raw, 1, 1) ~= '{' then
+        local sep = string.find(raw, '|', 1, true)
+        attempts, body = tonumber(string.sub(raw, 1, sep - 1)), string.sub(raw, sep + 1)
+    end
+    attempts = attempts + 1
+    redis.call('LPUSH', attempts >= tonumber(ARGV[2]) and KEYS[4] or KEYS[1], attempts .. '|' .. body)
+end
+return #expired
+"""
+def enqueue_update(data: dict) -> bool:
+    """Đẩy update vào hàng đợi (bỏ qua update Telegram gửi lại trùng `update_id`). Trả về True nếu đã đẩy."""
+    job = f"0|{json.dumps(data)}"
+    pushed = _run_lua('enqueue', _ENQUEUE_UPDATE_LUA, [f"jobs:seen:{data['update_id']}", JOB_QUEUE_KEY], [job, 3600])
+    if pushed and JOB_DRAIN_URL: _kick_job_worker()
+    return bool(pushed)
+
+def _kick_job_worker():
+    # Chỉ cần request tới được worker; không chờ worker xử lý xong.
+    try: http_request('internal', 'POST', JOB_DRAIN_URL, headers={'X-Cron-Secret': CRON_SECRET or ''}, timeout=(1, 0.05))
+    except requests.RequestException: pass
+
+def _split_job(raw: str) -> tuple[int, str]:
+    """Tách job thành (số lần thử, chuỗi update). Job dạng cũ (JSON còn trong hàng đợi lúc nâng cấp) tính là 0 lần."""
+    if raw.startswith('{'): return 0, raw
+    attempts, body = raw.split('|', 1)
+    return int(attempts), body
+
+def _job_update(raw: str) -> dict:
+    update = json.loads(_split_job(raw)[1])
+    return update if 'update_id' in update else update['update']  # Job dạng cũ bọc update trong {'id', 'update', 'attempts'}
+
+def _finish_job(raw: str, error: Exception | None):
+    if not _run_lua('ack', _ACK_JOB_LUA, [JOB_PROCESSING_KEY, JOB_LEASES_KEY], [raw]): return  # Lease đã hết hạn và job bị trả lại
+    if error is None: return
+    attempts, body = _split_job(raw)
+    attempts += 1
+    print(f"Job {_job_update(raw).get('update_id')} failed (attempt {attempts}): {error}")
+    kv.lpush(JOB_DEAD_KEY if attempts >= JOB_MAX_ATTEMPTS else JOB_QUEUE_KEY, f"{attempts}|{body}")
+
+def drain_jobs(time_budget: float = JOB_DRAIN_TIME_BUDGET) -> dict:
+    """
+    Xử lý job trong hàng đợi với tối đa JOB_WORKER_CONCURRENCY job song song, dừng nhận job mới khi hết thời gian.
+    Trả về: thống kê số job đã xử lý / lỗi / được trả lại / còn tồn.
+    """
+    deadline = datetime.now().timestamp() + time_budget
+    requeued = _run_lua('requeue', _REQUEUE_EXPIRED_JOBS_LUA,
+                               [JOB_QUEUE_KEY, JOB_PROCESSING_KEY, JOB_LEASES_KEY, JOB_DEAD_KEY],
+                               [datetime.now().timestamp(), JOB_MAX_ATTEMPTS])
+    processed = failed = 0
+    in_flight = {}
+    with ThreadPoolExecutor(max_workers=JOB_WORKER_CONCURRENCY, thread_name_prefix="job-worker") as executor:
+        queue_empty = False
+        while True:
+            while not queue_empty and len(in_flight) < JOB_WORKER_CONCURRENCY and datetime.now().timestamp() < deadline:
+                raw = _run_lua('claim', _CLAIM_JOB_LUA, [JOB_QUEUE_KEY, JOB_PROCESSING_KEY, JOB_LEASES_KEY],
+                                      [datetime.now().timestamp() + JOB_VISIBILITY_TIMEOUT])
+                if not raw: queue_empty = True; break
+                in_flight[executor.submit(handle_update, _job_update(raw))] = raw
+            if not in_flight: break
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                raw = in_flight.pop(future)
+                error = future.exception()
+                _finish_job(raw, error)
+                if error is None: processed += 1
+                else: failed += 1
+    return {'processed': processed, 'failed': failed, 'requeued': requeued, 'pending': kv.llen(JOB_QUEUE_KEY)}
+
+def run_job_worker(idle_sleep: float = 1.0):
+    """Worker chạy liên tục (tiến trình riêng, không dùng trên Vercel)."""
+    print("Job worker started.")
+    while True:
+        stats = drain_jobs()
+        flush_metrics()
+        if stats['processed'] or stats['failed'] or stats['requeued']: print(f"Job worker: {stats}")
+        if not stats['pending']: time.sleep(idle_sleep)
+
+# --- XỬ LÝ UPDATE TELEGRAM ---
+_METRIC_COMMANDS = {'/start', '/autonotify', '/donate', '/add', '/edit', '/del', '/list', '/gia', '/gt', '/calc', '/tr',
+                    '/event', '/folio', '/alpha', '/perp', '/alert', '/unalert', '/alerts'}
+
+def _update_metric_label(data: dict) -> str:
+    """Nhãn của update cho số liệu: tên lệnh đã biết, 'callback', 'address', 'text' (danh mục) hoặc 'other'."""
+    if "callback_query" in data: return "callback"
+    parts = ((data.get("message") or {}).get("text") or "").split()
+    if not parts: return "other"
+    cmd = parts[0].lower()
+    if cmd.startswith('/'): return cmd if cmd in _METRIC_COMMANDS else "/unknown"
+    return "address" if len(parts) == 1 and is_crypto_address(parts[0]) else "text"
+
+def _finish_streamed_message(chat_id, msg_id, text: str):
+    """Lần sửa cuối của câu trả lời LLM: dùng Markdown, gửi lại dạng thuần nếu Telegram không parse được."""
+    if not edit_telegram_message(chat_id, msg_id, text=text):
+        edit_telegram_message(chat_id, msg_id, text=text, parse_mode=None)
+
+def handle_update(data: dict):
+    """Xử lý một update và ghi số liệu theo lệnh (thời gian, kết quả, số round trip Redis)."""
+    command, start, roundtrips, status = _update_metric_label(data), time.perf_counter(), _redis_roundtrips(), "ok"
+    try:
+        _handle_update(data)
+    except Exception:
+        status = "error"; raise
+    finally:
+        observe_metric('bot_command_duration_seconds', time.perf_counter() - start, command=command)
+        inc_metric('bot_commands_total', command=command, status=status)
+        inc_metric('bot_command_redis_roundtrips_total', _redis_roundtrips() - roundtrips, command=command)
+
+def _handle_update(data: dict):
     if "callback_query" in data:
-        cb = data["callback_query"]; answer_callback_query(cb["id"])
-        if cb.get("data") == "refresh_portfolio" and "reply_to_message" in cb["message"]:
-            result = process_portfolio_text(cb["message"]["reply_to_message"]["text"])
-            if result: edit_telegram_message(cb["message"]["chat"]["id"], cb["message"]["message_id"], text=result, reply_markup=cb["message"]["reply_markup"])
-        return jsonify(success=True)
-    if "message" not in data or "text" not in data["message"]: return jsonify(success=True)
+        cb = data["callback_query"]
+        if cb.get("data") == "refresh_portfolio":
+            # Trả lời callback ngay (Telegram chỉ chờ vài giây); kết quả hiện ra qua chính tin được sửa.
+            answer_callback_query(cb["id"], "⏳ Đang cập nhật giá...")
+            chat_id, msg_id = cb["message"]["chat"]["id"], cb["message"]["message_id"]
+            status = refresh_portfolio_message(chat_id, msg_id, (cb["message"].get("reply_to_message") or {}).get("text"),
+                                               cb["message"].get("reply_markup"))
+            print(f"Portfolio refresh {chat_id}/{msg_id}: {status}")
+        else:
+            answer_callback_query(cb["id"])
+        return
+    if "message" not in data or "text" not in data["message"]: return
     chat_id = data["message"]["chat"]["id"]; msg_id = data["message"]["message_id"]
     text = data["message"]["text"].strip(); parts = text.split(); cmd = parts[0].lower()
     if cmd.startswith('/'):
@@ -937,7 +2431,9 @@ def webhook():
             else:
                 query = " ".join(parts[1:])
                 temp_msg_id = send_telegram_message(chat_id, text="🤔 Đang mò, chờ chút fen...", reply_to_message_id=msg_id)
-                if temp_msg_id: edit_telegram_message(chat_id, temp_msg_id, text=get_crypto_explanation(query))
+                if temp_msg_id:
+                    answer = get_crypto_explanation(query, on_progress=_ProgressiveEditor(chat_id, temp_msg_id, cmd))
+                    _finish_streamed_message(chat_id, temp_msg_id, answer)
         elif cmd == '/calc':
             send_telegram_message(chat_id, text=calculate_value(parts), reply_to_message_id=msg_id)
         elif cmd == '/tr':
@@ -945,7 +2441,9 @@ def webhook():
             else:
                 text_to_translate = " ".join(parts[1:])
                 temp_msg_id = send_telegram_message(chat_id, text="⏳ Đang dịch, đợi tí fen...", reply_to_message_id=msg_id)
-                if temp_msg_id: edit_telegram_message(chat_id, temp_msg_id, text=translate_crypto_text(text_to_translate))
+                if temp_msg_id:
+                    translation = translate_crypto_text(text_to_translate, on_progress=_ProgressiveEditor(chat_id, temp_msg_id, cmd))
+                    _finish_streamed_message(chat_id, temp_msg_id, translation)
         elif cmd == '/event':
             temp_msg_id = send_telegram_message(chat_id, text="🔍 Teeboo đang tìm, đợi tí fen 😏", reply_to_message_id=msg_id)
             if temp_msg_id:
@@ -989,36 +2487,71 @@ def webhook():
                 send_telegram_message(chat_id, text=unalert_price(chat_id, parts[1]), reply_to_message_id=msg_id)
         elif cmd == '/alerts':
             send_telegram_message(chat_id, text=list_price_alerts(chat_id), reply_to_message_id=msg_id)
-        return jsonify(success=True)
+        return
     
     if len(parts) == 1 and is_crypto_address(parts[0]):
         send_telegram_message(chat_id, text=find_token_across_networks(parts[0]), reply_to_message_id=msg_id, disable_web_page_preview=True)
     else:
-        portfolio_result = process_portfolio_text(text)
+        portfolio_items = parse_portfolio_lines(text)
+        portfolio_result = price_portfolio(portfolio_items)
         if portfolio_result:
             refresh_btn = {'inline_keyboard': [[{'text': '🔄 Refresh', 'callback_data': 'refresh_portfolio'}]]}
-            send_telegram_message(chat_id, text=portfolio_result, reply_to_message_id=msg_id, reply_markup=json.dumps(refresh_btn))
+            result_msg_id = send_telegram_message(chat_id, text=portfolio_result, reply_to_message_id=msg_id, reply_markup=json.dumps(refresh_btn))
+            remember_portfolio_message(chat_id, result_msg_id, portfolio_result, portfolio_items)
+
+# --- WEB SERVER (FLASK) ---
+app = Flask(__name__)
+
+@app.before_request
+def _start_request_metrics():
+    g.metrics_start, g.metrics_roundtrips = time.perf_counter(), _redis_roundtrips()
+
+@app.after_request
+def _record_request_metrics(response):
+    if 'metrics_start' in g:
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        observe_metric('bot_route_duration_seconds', time.perf_counter() - g.metrics_start, route=route)
+        inc_metric('bot_route_responses_total', route=route, status=response.status_code)
+        inc_metric('bot_route_redis_roundtrips_total', _redis_roundtrips() - g.metrics_roundtrips, route=route)
+    return response
+
+@app.teardown_request
+def _flush_request_metrics(exc):
+    flush_metrics()
+
+@app.route('/', methods=['GET', 'POST'])
+def webhook():
+    if request.method == 'GET':
+        return '''
+        <html>
+            <head>
+                <meta name="talentapp:project_verification" content="c6cf868d6d1698cf0b43b101e332f5ad9c891e925c371aaf2ec73ee23198897ce60c79f851d9c67d9ca150e10051c46c3f638f1e7aa18a403e1ce9c977ba3360">
+            </head>
+            <body>TeeBoo Bot Home</body>
+        </html>
+        '''
+    if not BOT_TOKEN: return "Server configuration error", 500
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict): return jsonify(success=False), 400
+    if WEBHOOK_ASYNC_MODE and kv and "update_id" in data:
+        enqueue_update(data)
+    else:
+        handle_update(data)
     return jsonify(success=True)
 
-def check_events_and_notify_groups():
+def check_events_and_notify_groups() -> dict:
     if not kv:
         print("Event check skipped: No DB connection.")
-        return 0
+        return {}
 
     print(f"[{datetime.now()}] Running group event notification check...")
     events, error = _get_processed_airdrop_events()
     if error or not events:
         print(f"Could not fetch events for notification: {error or 'No events found.'}")
-        return 0
+        return {'complete': True, 'remaining': 0, 'shards': {}, 'notifications_sent': 0}
 
-    notifications_sent = 0
+    messages = []
     now = datetime.now(TIMEZONE)
-    
-    subscribers = kv.smembers("event_notification_groups")
-    if not subscribers:
-        print("Event check skipped: No subscribed groups.")
-        return 0
-
     for event in events:
         event_time = event.get('effective_dt')
         if not event_time: continue
@@ -1029,26 +2562,44 @@ def check_events_and_notify_groups():
             if timedelta(minutes=0) < time_until_event <= timedelta(minutes=REMINDER_THRESHOLD_MINUTES):
                 event_id = f"{event.get('token')}-{event_time.isoformat()}"
                 
-                for chat_id in subscribers:
-                    redis_key = f"event_notified:{chat_id}:{event_id}"
-
-                    if not kv.exists(redis_key):
-                        minutes_left = int(time_until_event.total_seconds() // 60) + 1
-                        token, name = event.get('token', 'N/A'), event.get('name', 'N/A')
-                        
-                        message = (f"‼️ *ANH NHẮC EM*\n\n"
-                                   f"Sự kiện: *{name} ({token})*\n"
-                                   f"Thời gian: Trong vòng *{minutes_left} phút* nữa.")
-                        
-                        sent_message_id = send_telegram_message(chat_id, text=message)
-                        
-                        if sent_message_id:
-                            # pin_telegram_message(chat_id, sent_message_id)
-                            notifications_sent += 1
-                            kv.set(redis_key, "1", ex=3600)
-
-    print(f"Group event notification check finished. Sent: {notifications_sent} notifications.")
-    return notifications_sent
+                minutes_left = int(time_until_event.total_seconds() // 60) + 1
+                token, name = event.get('token', 'N/A'), event.get('name', 'N/A')
+                
+                messages.append((event_id, f"‼️ *ANH NHẮC EM*\n\n"
+                                           f"Sự kiện: *{name} ({token})*\n"
+                                           f"Thời gian: Trong vòng *{minutes_left} phút* nữa."))
+
+    if not messages:
+        print("Group event notification check finished. Sent: 0 notifications.")
+        return {'complete': True, 'remaining': 0, 'shards': {}, 'notifications_sent': 0}
+
+    result = run_cron_shards('check_events', lambda cron: _notify_event_shard(cron, messages), ('notifications_sent',))
+    print(f"Group event notification check finished. Sent: {result['notifications_sent']} notifications.")
+    return result
+
+def _notify_event_shard(cron: _CronPass, messages: list[tuple[str, str]]) -> tuple[bool, int]:
+    # Con trỏ: vị trí SSCAN trong tập nhóm đăng ký, số nhóm đã duyệt và tập sự kiện của vòng đó
+    # (sự kiện khác thì bắt đầu vòng mới để nhóm nào cũng được nhắc).
+    events_hash = _text_hash('\n'.join(event_id for event_id, _ in messages))
+    state = cron.cursor if (cron.cursor or {}).get('events') == events_hash else {'cursor': 0, 'done': 0, 'events': events_hash}
+    while not cron.out_of_time():
+        next_cursor, subscribers = kv.sscan("event_notification_groups", state['cursor'], count=CRON_BATCH_SIZE)
+        candidates = [(f"event_notified:{chat_id}:{event_id}", {'chat_id': chat_id, 'text': message})
+                      for event_id, message in messages for chat_id in subscribers if cron.owns(chat_id)]
+        if candidates:
+            # Nhận quyền gửi cho mọi cặp (sự kiện, nhóm) bằng SET NX trong một pipeline trước khi gửi:
+            # chỉ lần cron nhận được key mới gửi, nên hai lần chạy chồng nhau không thể gửi trùng.
+            pipe = kv.pipeline(transaction=False)
+            for redis_key, _ in candidates: pipe.set(redis_key, "1", nx=True, ex=3600)
+            outgoing = [message for (_, message), claimed in zip(candidates, pipe.execute()) if claimed]
+
+            # Tin lỗi tạm thời đã nằm trong hàng đợi gửi lại nên giữ nguyên key đã nhận.
+            results = send_telegram_messages(outgoing, cron.send_budget())
+            cron.count('notifications_sent', sum(1 for result in results if result['status'] == 'sent'))
+        state = {**state, 'cursor': int(next_cursor), 'done': state['done'] + len(subscribers)}
+        if state['cursor'] == 0: return True, 0
+        cron.save(state)
+    return False, cron.share(kv.scard("event_notification_groups") - state['done'])
 
 @app.route('/check_events', methods=['POST'])
 def event_cron_webhook():
@@ -1059,8 +2610,78 @@ def event_cron_webhook():
     if secret != CRON_SECRET:
         return jsonify(error="Unauthorized"), 403
 
-    sent_count = check_events_and_notify_groups()
-    return jsonify(success=True, notifications_sent=sent_count)
+    return jsonify(success=True, **check_events_and_notify_groups())
+
+def _check_reminders_shard(cron: _CronPass) -> tuple[bool, int]:
+    now = datetime.now(TIMEZONE)
+    now_ts = now.timestamp()
+    upper = now_ts + REMINDER_THRESHOLD_MINUTES * 60
+
+    # Con trỏ: score của mục cuối đã duyệt và số mục cùng score đó đã duyệt (score có thể trùng nhau).
+    # Cửa sổ đã trôi qua con trỏ thì bắt đầu vòng mới.
+    cursor = cron.cursor
+    if cursor and cursor['score'] > now_ts + 1: lower, skip = cursor['score'], cursor['skip']
+    else: lower, skip = f"({now_ts + 1}", 0
+
+    while not cron.out_of_time():
+        page = kv.zrangebyscore(TASK_DUE_INDEX_KEY, lower, upper, start=skip, num=CRON_BATCH_SIZE, withscores=True)
+        due = [(member.split('|', 1), score) for member, score in page]
+
+        # Lấy nội dung công việc và trạng thái đã nhắc của các mục thuộc shard bằng một pipeline.
+        pipe = kv.pipeline(transaction=False)
+        for (chat_id, task_id), _ in due:
+            if not cron.owns(chat_id): continue
+            pipe.hget(f"task_data:{chat_id}", task_id)
+            pipe.get(f"last_reminded:{chat_id}:{task_id}")
+        results = iter(pipe.execute())
+
+        outgoing, reminded, processed = [], {}, 0
+        for (chat_id, task_id), score in due:
+            if processed and cron.out_of_time(): break
+            processed += 1
+            if score == lower: skip += 1
+            else: lower, skip = score, 1
+            if not cron.owns(chat_id): continue
+            body, last_reminded_ts_str = next(results), next(results)
+            if not body: continue
+            if (datetime.now().timestamp() - float(last_reminded_ts_str or 0)) <= 270: continue
+            task = json.loads(body)
+
+            time_until_due = datetime.fromisoformat(task['time_iso']) - now
+            minutes_left = int(time_until_due.total_seconds() / 60)
+
+            reminder_text = f"‼️ *ANH NHẮC EM*\n\nSự kiện: *{task['name']}*\nSẽ diễn ra trong khoảng *{minutes_left} phút* nữa."
+
+            if task.get("type") == "alpha":
+                token_details = get_token_details_by_contract(task['contract'])
+                if token_details:
+                    price = token_details['price']
+                    value = price * task['amount']
+                    reminder_text = (
+                        f"‼️ *ANH NHẮC EM* ‼️\n\n"
+                        f"Sự kiện: *{task['name']}*\nSẽ diễn ra trong khoảng *{minutes_left} phút* nữa.\n\n"
+                        f"Giá token: `${price:,.6f}`\n"
+                        f"Tổng ≈ `${value:,.2f}`"
+                    )
+
+            outgoing.append({'chat_id': chat_id, 'text': reminder_text})
+            reminded[f"last_reminded:{chat_id}:{task_id}"] = (datetime.now().timestamp(), 3600)
+        # Trạng thái đã nhắc được ghi (có fencing) trước khi gửi: lần chạy đã mất lease dừng ở đây.
+        cron.fenced_set(reminded)
+        cron.count('reminders_sent', sum(1 for result in send_telegram_messages(outgoing, cron.send_budget()) if result['status'] == 'sent'))
+
+        if processed == len(due) and len(due) < CRON_BATCH_SIZE: return True, 0
+        cron.save({'score': lower, 'skip': skip})
+    return False, cron.share(kv.zcount(TASK_DUE_INDEX_KEY, lower, upper) - skip)
+
+def check_reminders() -> dict:
+    # Chỉ hỏi chỉ mục những công việc đến hạn trong cửa sổ nhắc, không quét dữ liệu của từng nhóm.
+    # Chỉ mục chưa đầy đủ khi dữ liệu cũ đang được chuyển ở instance khác: bỏ qua lần này thay vì nhắc thiếu.
+    if not _ensure_task_store_migrated():
+        print("Reminder check skipped: task store migration in progress.")
+        return {'complete': False, 'remaining': 0, 'shards': {}, 'migrating': True, 'reminders_sent': 0}
+    prune_expired_tasks(datetime.now(TIMEZONE).timestamp())
+    return run_cron_shards('check_reminders', _check_reminders_shard, ('reminders_sent',))
 
 @app.route('/check_reminders', methods=['POST'])
 def cron_webhook():
@@ -1069,59 +2690,7 @@ def cron_webhook():
     if secret != CRON_SECRET: return jsonify(error="Unauthorized"), 403
     
     print(f"[{datetime.now()}] Running reminder check...")
-    reminders_sent = 0
-    
-    for key in kv.scan_iter("tasks:*"):
-        chat_id = key.split(':')[1]
-        user_tasks = json.loads(kv.get(key) or '[]')
-        now = datetime.now(TIMEZONE)
-        active_tasks_after_check = []
-        tasks_changed = False
-        
-        for task in user_tasks:
-            task_time = datetime.fromisoformat(task['time_iso'])
-            if task_time > now:
-                active_tasks_after_check.append(task)
-                time_until_due = task_time - now
-                
-                if timedelta(seconds=1) < time_until_due <= timedelta(minutes=REMINDER_THRESHOLD_MINUTES):
-                    last_reminded_key = f"last_reminded:{chat_id}:{task['time_iso']}"
-                    last_reminded_ts_str = kv.get(last_reminded_key)
-                    last_reminded_ts = float(last_reminded_ts_str) if last_reminded_ts_str else 0
-                    
-                    if (datetime.now().timestamp() - last_reminded_ts) > 270:
-                        minutes_left = int(time_until_due.total_seconds() / 60)
-                        
-                        reminder_text = f"‼️ *ANH NHẮC EM*\n\nSự kiện: *{task['name']}*\nSẽ diễn ra trong khoảng *{minutes_left} phút* nữa."
-
-                        if task.get("type") == "alpha":
-                            token_details = get_token_details_by_contract(task['contract'])
-                            if token_details:
-                                price = token_details['price']
-                                value = price * task['amount']
-                                reminder_text = (
-                                    f"‼️ *ANH NHẮC EM* ‼️\n\n"
-                                    f"Sự kiện: *{task['name']}*\nSẽ diễn ra trong khoảng *{minutes_left} phút* nữa.\n\n"
-                                    f"Giá token: `${price:,.6f}`\n"
-                                    f"Tổng ≈ `${value:,.2f}`"
-                                )
-                        
-                        sent_message_id = send_telegram_message(chat_id, text=reminder_text)
-                        if sent_message_id:
-                            # pin_telegram_message(chat_id, sent_message_id)
-                            pass
-
-                        kv.set(last_reminded_key, datetime.now().timestamp(), ex=3600)
-                        reminders_sent += 1
-            else:
-                tasks_changed = True
-
-        if tasks_changed:
-            kv.set(key, json.dumps(active_tasks_after_check))
-
-    result = {"status": "success", "reminders_sent": reminders_sent}
-    print(result)
-    return jsonify(result)
+    return jsonify(status="success", **check_reminders())
 
 @app.route('/check_alerts', methods=['POST'])
 def alert_cron_webhook():
@@ -1129,5 +2698,43 @@ def alert_cron_webhook():
     secret = request.headers.get('X-Cron-Secret') or (request.is_json and request.get_json().get('secret'))
     if secret != CRON_SECRET: return jsonify(error="Unauthorized"), 403
     print(f"[{datetime.now()}] Running price alert check...")
-    check_price_alerts()
-    return jsonify(success=True)
\ No newline at end of file
+    return jsonify(success=True, **check_price_alerts())
+
+@app.route('/refresh_symbol_index', methods=['POST'])
+def symbol_index_cron_webhook():
+    if not kv or not CRON_SECRET: return jsonify(error="Server not configured"), 500
+    secret = request.headers.get('X-Cron-Secret') or (request.is_json and request.get_json().get('secret'))
+    if secret != CRON_SECRET: return jsonify(error="Unauthorized"), 403
+    count = refresh_symbol_index()
+    if count is None: return jsonify(error="Could not refresh symbol index"), 502
+    return jsonify(success=True, symbols=count)
+
+@app.route('/metrics', methods=['GET'])
+def metrics_webhook():
+    if not kv or not CRON_SECRET: return jsonify(error="Server not configured"), 500
+    auth = request.headers.get('Authorization', '')
+    # Chỉ nhận secret qua header: query string dễ lọt vào log truy cập và lịch sử trình duyệt.
+    secret = request.headers.get('X-Cron-Secret') or (auth[7:] if auth.startswith('Bearer ') else None)
+    if secret != CRON_SECRET: return jsonify(error="Unauthorized"), 403
+    return render_metrics(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+@app.route('/refresh_derivatives', methods=['POST'])
+def derivatives_cron_webhook():
+    if not kv or not CRON_SECRET: return jsonify(error="Server not configured"), 500
+    secret = request.headers.get('X-Cron-Secret') or (request.is_json and request.get_json().get('secret'))
+    if secret != CRON_SECRET: return jsonify(error="Unauthorized"), 403
+    count = refresh_derivatives_snapshot()
+    if count is None: return jsonify(error="Could not refresh derivatives snapshot"), 502
+    return jsonify(success=True, contracts=count)
+
+@app.route('/drain_jobs', methods=['POST'])
+def drain_jobs_webhook():
+    if not kv or not BOT_TOKEN or not CRON_SECRET: return jsonify(error="Server not configured"), 500
+    secret = request.headers.get('X-Cron-Secret') or (request.is_json and request.get_json().get('secret'))
+    if secret != CRON_SECRET: return jsonify(error="Unauthorized"), 403
+    return jsonify(success=True, **drain_jobs())
+
+if __name__ == "__main__":
+    import sys
+    if sys.argv[1:] == ["worker"]: run_job_worker()
+    else: app.run()
@@ -0,0 +1,208 @@
+"""
+Máy chủ HTTP giả lập các upstream của bot (Telegram, CoinGecko, GeckoTerminal, alpha123, Groq)
+để đo hiệu năng mà không gọi API thật.
+
+Mỗi upstream nằm dưới một tiền tố đường dẫn; `FakeUpstreams.env()` trả về các biến môi trường
+`*_API_BASE` trỏ bot về máy chủ này. Độ trễ và tỉ lệ lỗi được cấu hình theo từng upstream
+(khóa '*' là mặc định), ví dụ `FakeUpstreams(latency={'*': 0.05}, error_rate={'coingecko': 0.1})`.
+"""
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+COINS = [
+    ('bitcoin', 'btc', 'Bitcoin', 65000.0), ('ethereum', 'eth', 'Ethereum', 3200.0),
+    ('binancecoin', 'bnb', 'BNB', 580.0), ('solana', 'sol', 'Solana', 150.0),
+    ('ripple', 'xrp', 'XRP', 0.52), ('dogecoin', 'doge', 'Dogecoin', 0.12),
+]
+
+
+DEFAULT_ERROR_STATUS = {'telegram': 429}  # Các upstream khác trả 503 khi bị tiêm lỗi
+DEFAULT_TOKEN_PRICE = 1.2345
+
+
+class FakeUpstreams:
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, latency: dict | None = None,
+                 error_rate: dict | None = None, error_status: dict | None = None, seed: int = 0,
+                 llm_tokens: int = 60, llm_token_delay: float = 0.02):
+        self.latency = latency or {}  # upstream -> giây chờ trước khi trả lời
+        self.error_rate = error_rate or {}  # upstream -> xác suất trả lỗi
+        self.error_status = dict(DEFAULT_ERROR_STATUS, **(error_status or {}))
+        self.events = []  # Feed sự kiện alpha123 (xem `event_at`)
+        self.token_prices = {}  # (network, address_lower) -> giá; mặc định DEFAULT_TOKEN_PRICE
+        self.lock = threading.Lock()
+        self.calls = {}  # upstream -> số request đã nhận
+        self.errors = {}  # upstream -> số lỗi đã tiêm
+        self.methods = {}  # "upstream method" -> số request (ví dụ "telegram sendMessage")
+        self.first_call_at = {}  # "upstream method" -> time.perf_counter() của request đầu tiên kể từ reset_counters
+        self.llm_tokens, self.llm_token_delay = llm_tokens, llm_token_delay  # Độ dài và tốc độ sinh câu trả lời Groq
+        self.message_id = 0
+        self._random = random.Random(seed)
+        fakes = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args): pass
+
+            def do_GET(self): fakes._dispatch(self, 'GET')
+
+            def do_POST(self): fakes._dispatch(self, 'POST')
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.base_url = f"http://{host}:{self.server.server_address[1]}"
+        self._thread = None
+
+    def start(self) -> "FakeUpstreams":
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown(); self.server.server_close()
+
+    def env(self) -> dict:
+        return {
+            'TELEGRAM_API_BASE': f"{self.base_url}/telegram",
+            'COINGECKO_API_BASE': f"{self.base_url}/coingecko",
+            'GECKOTERMINAL_API_BASE': f"{self.base_url}/geckoterminal",
+            'ALPHA123_API_BASE': f"{self.base_url}/alpha123",
+            'GROQ_API_BASE': f"{self.base_url}/groq",
+        }
+
+    def reset_counters(self):
+        with self.lock: self.calls.clear(); self.errors.clear(); self.methods.clear(); self.first_call_at.clear()
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return {'calls': dict(self.calls), 'errors': dict(self.errors), 'methods': dict(self.methods),
+                    'first_call_at': dict(self.first_call_at)}
+
+    @staticmethod
+    def event_at(dt, token: str = 'BENCH', name: str = 'Bench Airdrop') -> dict:
+        """Sự kiện alpha123 diễn ra lúc `dt` (datetime có múi giờ); feed dùng giờ Trung Quốc."""
+        from datetime import timezone, timedelta
+        china_dt = dt.astimezone(timezone(timedelta(hours=8)))
+        return {'token': token, 'name': name, 'date': china_dt.strftime('%Y-%m-%d'),
+                'time': china_dt.strftime('%H:%M'), 'amount': '100', 'points': '200', 'phase': 1}
+
+    def _setting(self, table: dict, upstream: str, default=0):
+        return table.get(upstream, table.get('*', default))
+
+    # --- Định tuyến ---
+    def _dispatch(self, handler: BaseHTTPRequestHandler, method: str):
+        parts = urlsplit(handler.path)
+        upstream, _, path = parts.path.lstrip('/').partition('/')
+        query = {k: v[-1] for k, v in parse_qs(parts.query).items()}
+        length = int(handler.headers.get('Content-Length') or 0)
+        body = handler.rfile.read(length) if length else b''
+        with self.lock:
+            self.calls[upstream] = self.calls.get(upstream, 0) + 1
+            method_key = f"{upstream} {path.rsplit('/', 1)[-1] if upstream == 'telegram' else method}"
+            self.methods[method_key] = self.methods.get(method_key, 0) + 1
+            self.first_call_at.setdefault(method_key, time.perf_counter())
+            inject_error = self._random.random() < self._setting(self.error_rate, upstream)
+
+        delay = self._setting(self.latency, upstream)
+        if delay: time.sleep(delay)
+
+        headers = {}
+        if inject_error:
+            with self.lock: self.errors[upstream] = self.errors.get(upstream, 0) + 1
+            status = self._setting(self.error_status, upstream, 503)
+            payload = {'ok': False, 'error_code': status, 'description': 'Injected error'}
+            if status == 429:
+                headers['Retry-After'] = '1'
+                payload['parameters'] = {'retry_after': 1}
+        else:
+            route = getattr(self, f"_route_{upstream}", None)
+            status, payload = route(method, '/' + path, query, body) if route else (404, {'error': 'unknown upstream'})
+        if not isinstance(payload, (dict, list)):  # Generator các sự kiện SSE (Groq stream)
+            handler.send_response(status)
+            handler.send_header('Content-Type', 'text/event-stream')
+            handler.send_header('Connection', 'close')
+            handler.end_headers()
+            for event in payload:
+                handler.wfile.write(f"data: {event}\n\n".encode()); handler.wfile.flush()
+            handler.close_connection = True
+            return
+        data = json.dumps(payload).encode()
+        handler.send_response(status)
+        for name, value in headers.items(): handler.send_header(name, value)
+        handler.send_header('Content-Type', 'application/json')
+        handler.send_header('Content-Length', str(len(data)))
+        handler.end_headers()
+        handler.wfile.write(data)
+
+    def _route_telegram(self, method, path, query, body):
+        with self.lock:
+            self.message_id += 1
+            message_id = self.message_id
+        return 200, {'ok': True, 'result': {'message_id': message_id, 'date': int(time.time())}}
+
+    def _route_coingecko(self, method, path, query, body):
+        if path == '/simple/price':
+            ids = [i for i in query.get('ids', '').split(',') if i]
+            prices = {coin_id: price for coin_id, _, _, price in COINS}
+            return 200, {i: {'usd': prices.get(i, 1.0), 'usd_24h_change': 1.5} for i in ids}
+        if path == '/coins/list':
+            return 200, [{'id': coin_id, 'symbol': symbol, 'name': name} for coin_id, symbol, name, _ in COINS]
+        if path == '/coins/markets':
+            if query.get('page', '1') != '1': return 200, []
+            return 200, [{'id': coin_id, 'symbol': symbol, 'current_price': price} for coin_id, symbol, _, price in COINS]
+        if path == '/derivatives':
+            return 200, [{'symbol': f"{symbol.upper()}USDT", 'market': 'Binance (Futures)', 'funding_rate': 0.01}
+                         for _, symbol, _, _ in COINS]
+        return 404, {'error': 'not found'}
+
+    def _route_geckoterminal(self, method, path, query, body):
+        m = re.match(r'/networks/([^/]+)/tokens/multi/([^/]+)$', path)
+        if m:
+            return 200, {'data': [self._token(m.group(1), a) for a in m.group(2).split(',')]}
+        m = re.match(r'/networks/([^/]+)/tokens/([^/]+)$', path)
+        if m:
+            return 200, {'data': self._token(m.group(1), m.group(2))}
+        return 404, {'errors': [{'status': '404', 'title': 'Not Found'}]}
+
+    def _token(self, network: str, address: str) -> dict:
+        price = self.token_prices.get((network, address.lower()), DEFAULT_TOKEN_PRICE)
+        return {'id': f"{network}_{address}", 'type': 'token', 'attributes': {
+            'address': address, 'name': 'Bench Token', 'symbol': 'BENCH', 'price_usd': str(price),
+            'fdv_usd': '1000000', 'total_reserve_in_usd': '50000', 'volume_usd': {'h24': '12345'},
+            'price_change_percentage': {'h24': '2.5'}}}
+
+    def _route_alpha123(self, method, path, query, body):
+        if path.startswith('/api/price'):
+            return 200, {'success': True, 'prices': {'BENCH': {'price': 1.2345, 'dex_price': 1.2345}}}
+        if path == '/api/data':
+            return 200, {'airdrops': list(self.events)}
+        return 404, {'error': 'not found'}
+
+    def _route_groq(self, method, path, query, body):
+        if path != '/chat/completions': return 404, {'error': 'not found'}
+        request = json.loads(body or b'{}')
+        model, created = request.get('model', 'bench'), int(time.time())
+        words = [f"từ{i} " for i in range(self.llm_tokens)]
+        if not request.get('stream'):
+            time.sleep(self.llm_token_delay * len(words))
+            return 200, {
+                'id': 'chatcmpl-bench', 'object': 'chat.completion', 'created': created, 'model': model,
+                'choices': [{'index': 0, 'finish_reason': 'stop', 'message': {'role': 'assistant', 'content': ''.join(words)}}],
+                'usage': {'prompt_tokens': 10, 'completion_tokens': len(words), 'total_tokens': 10 + len(words)},
+            }
+
+        def events():
+            for i, word in enumerate(words):
+                time.sleep(self.llm_token_delay)
+                delta = {'role': 'assistant', 'content': word} if i == 0 else {'content': word}
+                yield json.dumps({'id': 'chatcmpl-bench', 'object': 'chat.completion.chunk', 'created': created, 'model': model,
+                                  'choices': [{'index': 0, 'delta': delta, 'finish_reason': None}]})
+            yield json.dumps({'id': 'chatcmpl-bench', 'object': 'chat.completion.chunk', 'created': created, 'model': model,
+                              'choices': [{'index': 0, 'delta': {}, 'finish_reason': 'stop'}]})
+            yield '[DONE]'
+        return 200, events()
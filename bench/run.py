@@ -0,0 +1,221 @@
+"""
+Benchmark toàn bộ bot với upstream giả (bench/fakes.py) và Redis giả (fakeredis) hoặc Redis thật.
+
+Báo cáo:
+  - webhook: độ trễ từng lệnh (lần đầu trong tiến trình, p50/p95/max các lần sau), thời điểm sửa tin đầu tiên
+    (nội dung đầu tiên người dùng thấy với /gt, /tr, /perp, /event) và số request upstream.
+  - crons: /check_reminders, /check_alerts, /check_events với N nhóm / công việc / cảnh báo.
+  - startup: khởi động lạnh (tiến trình mới) so với ấm (p50 của webhook).
+
+    python bench/run.py --chats 200 --alerts 1000 --latency 40 --latency telegram=80 --error-rate coingecko=0.05
+    python bench/run.py --json after.json --baseline before.json   # so sánh với lần chạy trước
+
+Lưu ý: với `--redis-url`, DB được chỉ định sẽ bị FLUSHDB trước mỗi lần chạy cron.
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import statistics
+import sys
+import time
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from bench.fakes import FakeUpstreams, DEFAULT_TOKEN_PRICE  # noqa: E402
+from bench.startup_bench import start_fake_redis, bench_env, measure_cold  # noqa: E402
+
+BENCH_ADDRESS = '0x' + 'ab' * 20
+CRON_SECRET = 'bench'
+
+
+def webhook_commands() -> list[str]:
+    tomorrow = (datetime.now() + timedelta(days=1)).strftime('%d/%m')
+    return [
+        '/start', '/gia btc', '/gia btc eth sol', '/calc eth 2', '/list', f'/add {tomorrow} 09:00 - Bench task',
+        '/perp btc', '/event', '/alerts', f'/alert {BENCH_ADDRESS} 5', '/gt bitcoin là gì', '/tr hello world',
+        BENCH_ADDRESS, '\n'.join(f"{i + 1}00 0x{i:040x} bsc" for i in range(5)),
+    ]
+
+
+def _percentile(values: list[float], pct: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+def _parse_setting(values: list[str], scale: float = 1.0) -> dict:
+    """'50' -> {'*': 50}, 'telegram=80' -> {'telegram': 80} (nhân với `scale`)."""
+    table = {}
+    for value in values or []:
+        upstream, _, number = value.rpartition('=')
+        table[upstream or '*'] = float(number) * scale
+    return table
+
+
+def _update(chat_id: int, text: str, message_id: int = 1) -> dict:
+    return {'update_id': message_id, 'message': {'message_id': message_id, 'chat': {'id': chat_id, 'type': 'group'}, 'text': text}}
+
+
+def bench_webhook(bot, fakes, iterations: int) -> dict:
+    client = bot.app.test_client()
+    results = {}
+    for command in webhook_commands():
+        samples, calls, first_edits = [], [], []
+        for i in range(iterations + 1):
+            fakes.reset_counters()
+            start = time.perf_counter()
+            client.post('/', json=_update(-100 - i, command, i + 1))
+            samples.append((time.perf_counter() - start) * 1000)
+            snapshot = fakes.snapshot()
+            calls.append(sum(snapshot['calls'].values()))
+            first_edit = snapshot['first_call_at'].get('telegram editMessageText')
+            if first_edit: first_edits.append((first_edit - start) * 1000)
+        warm = samples[1:] or samples
+        label = command.split('\n')[0] + (' (+folio)' if '\n' in command else '')
+        results[label[:40]] = {
+            'first_ms': samples[0], 'p50_ms': statistics.median(warm), 'p95_ms': _percentile(warm, 95),
+            'max_ms': max(warm), 'first_edit_ms': statistics.median(first_edits) if first_edits else None,
+            'upstream_calls_first': calls[0], 'upstream_calls_warm': statistics.median(calls[1:] or calls),
+        }
+    return results
+
+
+def _seed_reminders(bot, chat_base: int, chats: int, tasks_per_chat: int):
+    due = datetime.now(bot.TIMEZONE) + timedelta(minutes=3)
+    for chat in range(chats):
+        for i in range(tasks_per_chat):
+            bot._store_new_task(chat_base - chat, {"type": "simple", "time_iso": due.isoformat(), "name": f"Bench task {i}"}, due)
+
+
+def _seed_alerts(bot, chat_base: int, chats: int, alerts: int, trigger_ratio: float):
+    tokens = max(1, alerts // 2)  # Nhiều nhóm theo dõi cùng token, giống dữ liệu thật
+    pipe = bot.kv.pipeline(transaction=False)
+    for i in range(alerts):
+        chat_id, address = chat_base - (i % chats), f"0x{i % tokens:040x}"
+        reference_price = 1.0 if (i % tokens) < tokens * trigger_ratio else DEFAULT_TOKEN_PRICE
+        alert = {"address": address, "network": "bsc", "symbol": "BENCH", "name": "Bench Token", "chat_id": chat_id,
+                 "threshold_percent": 5.0, "reference_price": reference_price}
+        pipe.hset(bot.PRICE_ALERTS_KEY, f"{chat_id}:{address}", json.dumps(alert))
+        pipe.sadd(bot._chat_alerts_key(chat_id), address)
+        bot._index_alert_bands(pipe, f"{chat_id}:{address}", alert)
+    pipe.set(bot.PRICE_ALERTS_BAND_INDEX_READY_KEY, "1")
+    pipe.set(bot.PRICE_ALERTS_CHAT_INDEX_READY_KEY, "1")
+    pipe.execute()
+
+
+def _seed_events(bot, fakes, chat_base: int, chats: int):
+    starts_at = (datetime.now(bot.TIMEZONE) + timedelta(minutes=4)).replace(second=0, microsecond=0)
+    fakes.events = [FakeUpstreams.event_at(starts_at)]
+    bot.kv.sadd("event_notification_groups", *[chat_base - chat for chat in range(chats)])
+
+
+def bench_crons(bot, fakes, args) -> dict:
+    client = bot.app.test_client()
+    seeders = {
+        '/check_reminders': lambda base: _seed_reminders(bot, base, args.chats, args.tasks_per_chat),
+        '/check_alerts': lambda base: _seed_alerts(bot, base, args.chats, args.alerts, args.trigger_ratio),
+        '/check_events': lambda base: _seed_events(bot, fakes, base, args.chats),
+    }
+    results = {}
+    for run in range(args.cron_runs):
+        for route, seed in seeders.items():
+            # Mỗi lần chạy dùng dải chat_id mới để bucket giới hạn tốc độ theo nhóm không ảnh hưởng lần sau.
+            chat_base = -10 ** 9 - run * 10 ** 6
+            bot.kv.flushdb()
+            seed(chat_base)
+            fakes.reset_counters()
+            start = time.perf_counter()
+            res = client.post(route, headers={'X-Cron-Secret': CRON_SECRET})
+            elapsed = (time.perf_counter() - start) * 1000
+            snapshot = fakes.snapshot()
+            entry = results.setdefault(route, {'ms': [], 'sent': [], 'queued': [], 'upstream_calls': []})
+            entry['ms'].append(elapsed)
+            entry['sent'].append(snapshot['methods'].get('telegram sendMessage', 0) - snapshot['errors'].get('telegram', 0))
+            entry['queued'].append(bot.kv.zcard(bot.OUTBOX_RETRY_KEY))
+            entry['upstream_calls'].append(sum(snapshot['calls'].values()))
+            entry['status'] = res.status_code
+    return {route: {'ms': statistics.median(e['ms']), 'max_ms': max(e['ms']), 'sent': statistics.median(e['sent']),
+                    'queued': statistics.median(e['queued']), 'upstream_calls': statistics.median(e['upstream_calls']),
+                    'status': e['status']} for route, e in results.items()}
+
+
+def bench_startup(env: dict, webhook_results: dict, runs: int) -> dict:
+    results = {}
+    for command in ['/start', '/gia btc', '/list', '/gt bitcoin là gì']:
+        samples = measure_cold(command, env, runs)
+        warm = webhook_results.get(command, {}).get('p50_ms')
+        results[command] = {'cold_import_ms': statistics.median(s['import_ms'] for s in samples),
+                            'cold_total_ms': statistics.median(s['total_ms'] for s in samples), 'warm_ms': warm}
+    return results
+
+
+def print_report(results: dict, baseline: dict | None):
+    def delta(section, name, key, value):
+        old = ((baseline or {}).get(section) or {}).get(name, {}).get(key)
+        if not isinstance(old, (int, float)) or not isinstance(value, (int, float)) or not old: return ''
+        return f" ({(value - old) / old * 100:+.0f}%)"
+
+    for section, rows in results.items():
+        if section == 'config' or not rows: continue
+        columns = list(next(iter(rows.values())).keys())
+        widths = [max(12, len(c) + 2) + (8 if baseline else 0) for c in columns]
+        print(f"\n== {section} ==")
+        print(f"{'':<42}" + ''.join(f"{c:>{w}}" for c, w in zip(columns, widths)))
+        for name, row in rows.items():
+            cells = []
+            for c, w in zip(columns, widths):
+                v = row[c]
+                text = '-' if v is None else (f"{v:.1f}" if isinstance(v, float) else str(v))
+                cells.append(f"{text + delta(section, name, c, v):>{w}}")
+            print(f"{name:<42}" + ''.join(cells))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--only', default='webhook,crons,startup', help='Các phần cần chạy, cách nhau bởi dấu phẩy')
+    parser.add_argument('--iterations', type=int, default=10, help='Số lần gọi ấm cho mỗi lệnh webhook')
+    parser.add_argument('--chats', type=int, default=100)
+    parser.add_argument('--tasks-per-chat', type=int, default=2)
+    parser.add_argument('--alerts', type=int, default=500)
+    parser.add_argument('--trigger-ratio', type=float, default=0.1, help='Tỉ lệ token có cảnh báo bị kích hoạt')
+    parser.add_argument('--cron-runs', type=int, default=3)
+    parser.add_argument('--startup-runs', type=int, default=3)
+    parser.add_argument('--latency', action='append', help="Độ trễ upstream (ms): '40' hoặc 'telegram=80'")
+    parser.add_argument('--error-rate', action='append', help="Tỉ lệ lỗi: '0.01' hoặc 'coingecko=0.05'")
+    parser.add_argument('--redis-url', help='Redis thật; mặc định dùng fakeredis qua TCP')
+    parser.add_argument('--json', help='Ghi kết quả ra file JSON')
+    parser.add_argument('--baseline', help='File JSON của lần chạy trước để so sánh')
+    args = parser.parse_args()
+    sections = set(args.only.split(','))
+
+    fakes = FakeUpstreams(latency=_parse_setting(args.latency or ['20'], 0.001), error_rate=_parse_setting(args.error_rate)).start()
+    env = bench_env(fakes, args.redis_url or start_fake_redis())
+    os.environ.update({k: env[k] for k in list(fakes.env()) + ['TELEGRAM_TOKEN', 'CRON_SECRET', 'GROQ_API_KEY',
+                                                               'teeboov2_REDIS_URL', 'WEBHOOK_ASYNC_MODE']})
+
+    log = io.StringIO()
+    with contextlib.redirect_stdout(log):
+        import api.index as bot
+        bot.kv.flushdb()
+
+    results = {'config': vars(args)}
+    with contextlib.redirect_stdout(log):
+        if 'webhook' in sections or 'startup' in sections: results['webhook'] = bench_webhook(bot, fakes, args.iterations)
+        if 'crons' in sections: results['crons'] = bench_crons(bot, fakes, args)
+    if 'startup' in sections: results['startup'] = bench_startup(env, results['webhook'], args.startup_runs)
+    if 'webhook' not in sections: results.pop('webhook', None)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f: baseline = json.load(f)
+    print_report(results, baseline)
+    if args.json:
+        with open(args.json, 'w') as f: json.dump(results, f, indent=2, ensure_ascii=False)
+    fakes.stop()
+
+
+if __name__ == '__main__':
+    main()
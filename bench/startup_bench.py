@@ -0,0 +1,107 @@
+"""
+Đo thời gian khởi động lạnh: mỗi lệnh chạy trong một tiến trình Python mới, đo thời gian
+import `api.index` và thời gian tới khi webhook trả lời update đầu tiên.
+
+    python bench/startup_bench.py                  # Redis giả (fakeredis TCP), upstream giả
+    python bench/startup_bench.py --redis-url redis://localhost:6379/15 --runs 5 /gia /gt
+
+Lưu ý: các lệnh dùng Redis thật sẽ ghi dữ liệu vào DB được chỉ định.
+"""
+import argparse
+import ast
+import json
+import os
+import statistics
+import subprocess
+import sys
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+DEFAULT_COMMANDS = ['/start', '/gia btc', '/list', '/gt bitcoin là gì', '/perp btc', '/event', '/alerts']
+
+
+def _child(command: str):
+    """Chạy trong tiến trình con: đo import và phản hồi đầu tiên cho `command`."""
+    t0 = time.perf_counter()
+    from api.index import app
+    t1 = time.perf_counter()
+    update = {'update_id': 1, 'message': {'message_id': 1, 'chat': {'id': -100, 'type': 'group'}, 'text': command}}
+    res = app.test_client().post('/', json=update)
+    t2 = time.perf_counter()
+    print(json.dumps({'import_ms': (t1 - t0) * 1000, 'first_response_ms': (t2 - t1) * 1000,
+                      'total_ms': (t2 - t0) * 1000, 'status': res.status_code}))
+
+
+def start_fake_redis() -> str:
+    """Chạy fakeredis qua TCP trong tiến trình hiện tại; trả về URL kết nối."""
+    from fakeredis import TcpFakeServer
+    server = TcpFakeServer(('127.0.0.1', 0), server_type='redis')
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    host, port = server.server_address[:2]
+    url = f"redis://{host}:{port}/0"
+    preload_lua_scripts(url)
+    return url
+
+
+def preload_lua_scripts(redis_url: str):
+    """
+    Nạp sẵn các script `*_LUA` của bot (đọc bằng ast, không import bot).
+    Máy chủ TCP của fakeredis đóng kết nối sau lỗi NOSCRIPT, vốn là bước đầu tiên của EVALSHA.
+    """
+    import redis
+    with open(os.path.join(ROOT, 'api', 'index.py'), encoding='utf-8') as f: tree = ast.parse(f.read())
+    client = redis.Redis.from_url(redis_url)
+    for node in tree.body:
+        if isinstance(node, ast.Assign) and isinstance(node.value, ast.Constant) and isinstance(node.value.value, str) \
+                and any(isinstance(t, ast.Name) and t.id.endswith('_LUA') for t in node.targets):
+            client.script_load(node.value.value)
+    client.close()
+
+
+def bench_env(fakes, redis_url: str) -> dict:
+    return dict(os.environ, **fakes.env(), TELEGRAM_TOKEN='bench', CRON_SECRET='bench', GROQ_API_KEY='bench',
+                teeboov2_REDIS_URL=redis_url, WEBHOOK_ASYNC_MODE='0')
+
+
+def measure_cold(command: str, env: dict, runs: int) -> list[dict]:
+    """Chạy `command` trong `runs` tiến trình mới; trả về các mẫu đo (ném RuntimeError nếu tiến trình con lỗi)."""
+    samples = []
+    for _ in range(runs):
+        out = subprocess.run([sys.executable, os.path.abspath(__file__), '--child', command],
+                             env=env, cwd=ROOT, capture_output=True, text=True)
+        lines = [line for line in out.stdout.splitlines() if line.startswith('{')]
+        if out.returncode != 0 or not lines: raise RuntimeError(out.stderr.strip()[-2000:])
+        samples.append(json.loads(lines[-1]))
+    return samples
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('commands', nargs='*', default=DEFAULT_COMMANDS)
+    parser.add_argument('--runs', type=int, default=3, help='Số lần chạy lạnh cho mỗi lệnh')
+    parser.add_argument('--redis-url', help='Redis thật; mặc định dùng fakeredis qua TCP')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child is not None: return _child(args.child)
+
+    from bench.fakes import FakeUpstreams
+    fakes = FakeUpstreams().start()
+    env = bench_env(fakes, args.redis_url or start_fake_redis())
+
+    print(f"{'command':<22}{'import ms':>12}{'first resp ms':>16}{'total ms':>12}")
+    for command in args.commands:
+        try:
+            samples = measure_cold(command, env, args.runs)
+        except RuntimeError as e:
+            print(f"{command:<22}FAILED\n{e}"); continue
+        med = lambda k: statistics.median(s[k] for s in samples)
+        print(f"{command:<22}{med('import_ms'):>12.1f}{med('first_response_ms'):>16.1f}{med('total_ms'):>12.1f}")
+    fakes.stop()
+
+
+if __name__ == '__main__':
+    main()